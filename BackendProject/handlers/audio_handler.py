@@ -1,11 +1,14 @@
+import asyncio
 import base64
 import json
-from typing import Dict, List
-from datetime import datetime
 import os
-import aiofiles
+import time
+from typing import Dict, List, Tuple
+from datetime import datetime
 from dotenv import load_dotenv
 
+from handlers.audio_normalizer import audio_normalizer
+
 # 加载环境变量
 load_dotenv()
 
@@ -13,9 +16,32 @@ class AudioProcessor:
     def __init__(self):
         self.audio_buffers: Dict[str, List[bytes]] = {}
         self.is_recording: Dict[str, bool] = {}
+        # 客户端声明的采样率和声道数，仅在无法从文件头识别格式时使用
+        self.audio_params: Dict[str, Tuple[int, int]] = {}
+        # 单段录音的字节数和块数上限，以及所有客户端音频缓冲的总字节数上限
+        self.max_utterance_bytes = int(float(os.getenv("AUDIO_MAX_UTTERANCE_MB", "8")) * 1024 * 1024)
+        self.max_chunks = int(os.getenv("AUDIO_MAX_CHUNKS", "4000"))
+        self.max_total_bytes = int(float(os.getenv("AUDIO_MAX_BUFFER_MB", "256")) * 1024 * 1024)
+        self.buffer_bytes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.metrics: Dict[str, int] = {
+            "rejected_utterance_bytes": 0,
+            "rejected_chunk_count": 0,
+            "rejected_total_bytes": 0,
+            "aborted_streams": 0,
+        }
+
+    def _reset_buffer(self, client_id: str, keep: bool = True):
+        """清空客户端的音频缓冲并更新字节计数"""
+        self.total_bytes -= self.buffer_bytes.pop(client_id, 0)
+        if keep:
+            self.audio_buffers[client_id] = []
+            self.buffer_bytes[client_id] = 0
+        else:
+            self.audio_buffers.pop(client_id, None)
 
     def start_audio_stream(self, client_id: str):
-        self.audio_buffers[client_id] = []
+        self._reset_buffer(client_id)
         self.is_recording[client_id] = True
         print(f"[AudioProcessor] 开始处理客户端 {client_id} 的音频流")
 
@@ -24,6 +50,22 @@ class AudioProcessor:
         print(f"[AudioProcessor] 停止处理客户端 {client_id} 的音频流")
         # 缓冲区会在_process_complete_audio中清理
 
+    def abort_audio_stream(self, client_id: str) -> bool:
+        """丢弃进行中的录音（有音频块被限流丢弃时调用，残缺的录音无法正确识别），返回是否有被中止的录音"""
+        if not self.is_recording.get(client_id, False):
+            return False
+        self.is_recording[client_id] = False
+        self._reset_buffer(client_id)
+        self.metrics["aborted_streams"] += 1
+        print(f"[AudioProcessor] 客户端 {client_id} 的音频块被丢弃，录音已中止")
+        return True
+
+    def release(self, client_id: str):
+        """释放客户端的全部音频状态（连接断开或被回收时调用）"""
+        self._reset_buffer(client_id, keep=False)
+        self.is_recording.pop(client_id, None)
+        self.audio_params.pop(client_id, None)
+
     async def process_audio_chunk(self, client_id: str, audio_data: dict) -> Dict:
         try:
             if not self.is_recording.get(client_id, False):
@@ -35,11 +77,22 @@ class AudioProcessor:
             if not audio_chunk_base64:
                 return {"status": "error", "message": "音频数据为空"}
 
+            # 解码前按base64长度估算大小，超出上限的块直接拒绝
+            rejection = self._check_limits(client_id, len(audio_chunk_base64) * 3 // 4)
+            if rejection:
+                return {"status": "error", "message": rejection}
+
             audio_bytes = base64.b64decode(audio_chunk_base64)
             if client_id not in self.audio_buffers:
-                self.audio_buffers[client_id] = []
+                self._reset_buffer(client_id)
 
             self.audio_buffers[client_id].append(audio_bytes)
+            self.buffer_bytes[client_id] += len(audio_bytes)
+            self.total_bytes += len(audio_bytes)
+            self.audio_params[client_id] = (
+                int(audio_data.get("sample_rate", 16000)),
+                int(audio_data.get("channels", 1))
+            )
 
             return {
                 "status": "success",
@@ -50,6 +103,27 @@ class AudioProcessor:
         except Exception as e:
             return {"status": "error", "message": f"音频处理失败: {str(e)}"}
 
+    def _check_limits(self, client_id: str, size: int) -> str:
+        """检查录音长度和缓冲总量，超限时返回错误信息"""
+        if self.buffer_bytes.get(client_id, 0) + size > self.max_utterance_bytes:
+            self.metrics["rejected_utterance_bytes"] += 1
+            return f"录音过长，单段录音最多 {self.max_utterance_bytes} 字节"
+        if len(self.audio_buffers.get(client_id, ())) >= self.max_chunks:
+            self.metrics["rejected_chunk_count"] += 1
+            return f"音频块过多，单段录音最多 {self.max_chunks} 块"
+        if self.total_bytes + size > self.max_total_bytes:
+            self.metrics["rejected_total_bytes"] += 1
+            return "服务器音频缓冲已满，请稍后再试"
+        return ""
+
+    def get_metrics(self) -> Dict[str, int]:
+        """获取音频缓冲占用和超限拒绝统计"""
+        return {
+            **self.metrics,
+            "recording_clients": sum(1 for recording in self.is_recording.values() if recording),
+            "buffered_bytes": self.total_bytes,
+        }
+
     async def _process_complete_audio(self, client_id: str):
         print("[AudioProcessor] 处理完整音频")
         if client_id not in self.audio_buffers or not self.audio_buffers[client_id]:
@@ -58,40 +132,48 @@ class AudioProcessor:
 
         print(f"[AudioProcessor] 处理完整音频，总大小: {len(all_audio_data)} 字节")
 
-        # 保存音频到本地
-        audio_filename = await self._save_audio_file(client_id, all_audio_data)
-
-        # 调用语音识别API
-        transcription = await self._transcribe_audio(audio_filename)
+        sample_rate, channels = self.audio_params.get(client_id, (16000, 1))
+        transcription = await self.transcribe_bytes(client_id, all_audio_data, sample_rate, channels)
 
         # 清理缓冲区
-        self.audio_buffers[client_id] = []
+        self._reset_buffer(client_id)
 
         return transcription
 
-    async def _save_audio_file(self, client_id: str, audio_data: bytes) -> str:
-        """保存音频数据到本地文件"""
-        # 创建音频目录
-        audio_dir = "audio_files"
-        if not os.path.exists(audio_dir):
-            os.makedirs(audio_dir)
+    async def transcribe_bytes(self, client_id: str, audio_data: bytes, sample_rate: int = 16000, channels: int = 1) -> str:
+        """规整、保存并识别一段完整音频（WebSocket录音和HTTP上传的音频文件共用）"""
+        # 探测格式并规整为16kHz单声道，解码和编码放到线程中避免阻塞事件循环
+        normalized = await asyncio.to_thread(
+            audio_normalizer.normalize, audio_data, sample_rate, channels
+        )
+
+        # 保存音频到本地
+        audio_filename = await self._save_audio_file(
+            client_id, normalized["data"], normalized["extension"]
+        )
+
+        # 调用语音识别API
+        asr_start = time.perf_counter()
+        transcription = await self._transcribe_audio(audio_filename, normalized["mime"])
+        audio_normalizer.record(normalized, (time.perf_counter() - asr_start) * 1000)
+        return transcription
+
+    async def _save_audio_file(self, client_id: str, audio_data: bytes, extension: str = "wav") -> str:
+        """保存音频数据到本地分片目录"""
+        from services.storage_service import audio_storage
 
         # 生成文件名
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{audio_dir}/audio_{client_id}_{timestamp}.wav"
-
-        # 保存文件
-        async with aiofiles.open(filename, "wb") as f:
-            await f.write(audio_data)
+        filename = await audio_storage.save(f"audio_{client_id}_{timestamp}.{extension}", audio_data)
 
         print(f"[AudioProcessor] 音频已保存到: {filename}")
         return filename
 
-    async def _transcribe_audio(self, audio_filepath: str) -> str:
-        """调用SiliconFlow语音识别API"""
-        from services.http_service import http_service
+    async def _transcribe_audio(self, audio_filepath: str, content_type: str = "audio/wav") -> str:
+        """调用配置的语音识别后端（SiliconFlow或本地模型）"""
+        from services.asr_service import asr_service
 
-        transcription = await http_service.transcribe_audio(audio_filepath)
+        transcription = await asr_service.transcribe_audio(audio_filepath, content_type)
         return transcription if transcription else ""
 
 class MessageParser:
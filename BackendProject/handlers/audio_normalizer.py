@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+音频规整模块
+负责在上传语音识别之前对录音进行格式探测、解码、降混、重采样、静音裁剪和重新编码
+"""
+import io
+import os
+import time
+import wave
+from typing import Dict
+
+import numpy as np
+from dotenv import load_dotenv
+
+try:
+    import av
+except ImportError:  # PyAV为可选依赖，缺失时仅支持WAV/PCM解码
+    av = None
+
+# 加载环境变量
+load_dotenv()
+
+# 各容器格式对应的文件扩展名和MIME类型
+FORMAT_INFO = {
+    "wav": ("wav", "audio/wav"),
+    "pcm": ("pcm", "audio/L16"),
+    "webm": ("webm", "audio/webm"),
+    "ogg": ("ogg", "audio/ogg"),
+    "mp3": ("mp3", "audio/mpeg"),
+    "flac": ("flac", "audio/flac"),
+    "mp4": ("m4a", "audio/mp4"),
+}
+
+# 上传格式对应的PyAV编码器，auto时按顺序选择第一个可用的
+UPLOAD_ENCODERS = {"opus": "libopus", "flac": "flac"}
+
+
+def can_encode(upload_format: str) -> bool:
+    """检查PyAV是否可用且带有该上传格式的编码器"""
+    if av is None or upload_format not in UPLOAD_ENCODERS:
+        return False
+    try:
+        av.codec.Codec(UPLOAD_ENCODERS[upload_format], "w")
+        return True
+    except Exception:
+        return False
+
+
+def is_mpeg_frame_header(header: bytes) -> bool:
+    """检查是否为完整有效的MPEG音频帧头：同步位、版本、层、码率和采样率字段均不能为保留值
+
+    只看同步位时，接近静音的小端int16 PCM（FF FF / FF Ex）也会被误判为MP3
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return False
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    emphasis = header[3] & 0x03
+    return (
+        version != 0b01
+        and layer != 0b00
+        and bitrate_index not in (0b0000, 0b1111)
+        and sample_rate_index != 0b11
+        and emphasis != 0b10
+    )
+
+
+def detect_audio_format(header: bytes) -> str:
+    """根据文件头字节探测音频容器格式
+
+    Args:
+        header: 音频数据的前若干字节
+
+    Returns:
+        格式名称（wav/webm/ogg/mp3/flac/mp4），无法识别时返回pcm
+    """
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "wav"
+    if header[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if header[:4] == b"OggS":
+        return "ogg"
+    if header[:4] == b"fLaC":
+        return "flac"
+    if header[:3] == b"ID3" or is_mpeg_frame_header(header):
+        return "mp3"
+    if header[4:8] == b"ftyp":
+        return "mp4"
+    return "pcm"
+
+
+class AudioNormalizer:
+    """音频规整器：统一转换为16kHz单声道并压缩上传体积"""
+
+    def __init__(self):
+        self.enabled = os.getenv("AUDIO_NORMALIZE", "true").lower() == "true"
+        self.target_rate = int(os.getenv("ASR_SAMPLE_RATE", "16000"))
+        # auto: 优先opus，其次flac，PyAV不可用时为wav
+        self.upload_format = os.getenv("ASR_UPLOAD_FORMAT", "auto").lower()
+        # 静音判定阈值（dBFS）和首尾保留的静音时长
+        self.silence_db = float(os.getenv("AUDIO_SILENCE_DB", "-45"))
+        self.silence_pad_ms = int(os.getenv("AUDIO_SILENCE_PAD_MS", "150"))
+        # 按处理方式（raw/normalized）统计的上传字节数和识别耗时
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+        if self.upload_format == "auto":
+            self.upload_format = next((f for f in UPLOAD_ENCODERS if can_encode(f)), "wav")
+            print(f"[AudioNormalizer] 上传格式: {self.upload_format}")
+        elif self.upload_format != "wav" and not can_encode(self.upload_format):
+            print(f"[AudioNormalizer] PyAV不可用或缺少编码器，上传格式 {self.upload_format} 回退为 wav")
+            self.upload_format = "wav"
+
+    def normalize(self, audio_data: bytes, sample_rate: int = 16000, channels: int = 1) -> Dict:
+        """规整一段完整录音
+
+        Args:
+            audio_data: 客户端上传的原始音频字节
+            sample_rate: 客户端声明的采样率（仅对裸PCM生效）
+            channels: 客户端声明的声道数（仅对裸PCM生效）
+
+        Returns:
+            包含 data/extension/mime/source_format/mode/original_bytes/duration/decode_ms 的字典
+        """
+        start = time.perf_counter()
+        source_format = detect_audio_format(audio_data[:16])
+        extension, mime = FORMAT_INFO[source_format]
+        result = {
+            "data": audio_data,
+            "extension": extension,
+            "mime": mime,
+            "source_format": source_format,
+            "mode": "raw",
+            "original_bytes": len(audio_data),
+            "duration": None,
+        }
+
+        if self.enabled:
+            try:
+                samples, rate, decoded_format = self._decode_detected(audio_data, source_format, sample_rate, channels)
+                if decoded_format != source_format:
+                    source_format = decoded_format
+                    extension, mime = FORMAT_INFO[source_format]
+                    result.update({"extension": extension, "mime": mime, "source_format": source_format})
+                if samples is not None:
+                    samples = self._downmix(samples)
+                    samples = self._resample(samples, rate, self.target_rate)
+                    samples = self._trim_silence(samples, self.target_rate)
+                    if samples.size == 0:
+                        print("[AudioNormalizer] 录音中未检测到有效语音")
+                    else:
+                        extension, mime, encoded = self._encode(samples, self.target_rate)
+                        # 规整后没有变小时保留原始数据（裸PCM除外，语音识别接口无法识别无文件头的数据）
+                        if len(encoded) >= len(audio_data) and source_format != "pcm":
+                            print(f"[AudioNormalizer] 规整后 {len(encoded)} 字节不小于原始数据，按原始数据上传")
+                        else:
+                            result.update({
+                                "data": encoded,
+                                "extension": extension,
+                                "mime": mime,
+                                "mode": "normalized",
+                                "duration": samples.size / self.target_rate,
+                            })
+                else:
+                    print(f"[AudioNormalizer] 无法解码 {source_format} 格式，按原始数据上传")
+            except Exception as e:
+                print(f"[AudioNormalizer] 音频规整失败，按原始数据上传: {str(e)}")
+
+        result["decode_ms"] = (time.perf_counter() - start) * 1000
+        print(
+            f"[AudioNormalizer] {source_format} -> {result['extension']}，"
+            f"{result['original_bytes']} 字节 -> {len(result['data'])} 字节，"
+            f"耗时 {result['decode_ms']:.1f} ms"
+        )
+        return result
+
+    def decode_mono(self, audio_data: bytes, sample_rate: int = 16000, channels: int = 1):
+        """解码为单声道float32采样，返回 (采样数组, 采样率)，无法解码时返回 (None, 0)"""
+        source_format = detect_audio_format(audio_data[:16])
+        samples, rate, _ = self._decode_detected(audio_data, source_format, sample_rate, channels)
+        if samples is None:
+            return None, 0
+        return self._downmix(samples), rate
+
+    def record(self, result: Dict, asr_ms: float):
+        """记录一次上传的字节数和识别耗时，用于对比规整前后的效果"""
+        entry = self.stats.setdefault(result["mode"], {
+            "count": 0,
+            "original_bytes": 0,
+            "upload_bytes": 0,
+            "decode_ms": 0.0,
+            "asr_ms": 0.0,
+        })
+        entry["count"] += 1
+        entry["original_bytes"] += result["original_bytes"]
+        entry["upload_bytes"] += len(result["data"])
+        entry["decode_ms"] += result["decode_ms"]
+        entry["asr_ms"] += asr_ms
+        print(
+            f"[AudioNormalizer] 上传 {len(result['data'])} 字节（原始 {result['original_bytes']} 字节），"
+            f"识别耗时 {asr_ms:.1f} ms"
+        )
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """获取各处理方式的平均字节数和平均识别耗时"""
+        report = {}
+        for mode, entry in self.stats.items():
+            count = entry["count"] or 1
+            report[mode] = {
+                "count": entry["count"],
+                "avg_original_bytes": entry["original_bytes"] / count,
+                "avg_upload_bytes": entry["upload_bytes"] / count,
+                "avg_decode_ms": entry["decode_ms"] / count,
+                "avg_asr_ms": entry["asr_ms"] / count,
+            }
+        return report
+
+    def _decode_detected(self, audio_data: bytes, source_format: str, sample_rate: int, channels: int):
+        """按探测到的格式解码，MP3解码失败时按裸PCM重试（帧头仍可能与PCM采样偶然吻合）
+
+        Returns:
+            (采样数组, 采样率, 实际格式)
+        """
+        try:
+            samples, rate = self._decode(audio_data, source_format, sample_rate, channels)
+            return samples, rate, source_format
+        except Exception as e:
+            if source_format != "mp3":
+                raise
+            print(f"[AudioNormalizer] 按MP3解码失败，按裸PCM重试: {str(e)}")
+        samples, rate = self._decode(audio_data, "pcm", sample_rate, channels)
+        return samples, rate, "pcm"
+
+    def _decode(self, audio_data: bytes, source_format: str, sample_rate: int, channels: int):
+        """解码为 (声道, 采样点) 的float32数组，无法解码时返回 (None, 0)"""
+        if source_format == "wav":
+            with wave.open(io.BytesIO(audio_data), "rb") as wav_file:
+                width = wav_file.getsampwidth()
+                rate = wav_file.getframerate()
+                wav_channels = wav_file.getnchannels()
+                frames = wav_file.readframes(wav_file.getnframes())
+            return self._pcm_to_float(frames, width, wav_channels), rate
+
+        if source_format == "pcm":
+            return self._pcm_to_float(audio_data, 2, channels), sample_rate
+
+        if av is None:
+            return None, 0
+
+        chunks = []
+        rate = 0
+        with av.open(io.BytesIO(audio_data)) as container:
+            stream = container.streams.audio[0]
+            # 统一转换为平面float格式，降混和重采样交给NumPy处理
+            resampler = av.AudioResampler(format="fltp")
+            for frame in container.decode(stream):
+                rate = frame.sample_rate
+                for out_frame in resampler.resample(frame):
+                    chunks.append(out_frame.to_ndarray())
+        if not chunks:
+            return np.zeros((1, 0), dtype=np.float32), rate or sample_rate
+        return np.concatenate(chunks, axis=1).astype(np.float32, copy=False), rate
+
+    @staticmethod
+    def _pcm_to_float(frames: bytes, width: int, channels: int) -> np.ndarray:
+        """将交错存储的整型PCM转换为 (声道, 采样点) 的float32数组"""
+        if width == 1:
+            samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+        elif width == 2:
+            usable = len(frames) - len(frames) % 2
+            samples = np.frombuffer(frames[:usable], dtype="<i2").astype(np.float32) / 32768.0
+        elif width == 4:
+            usable = len(frames) - len(frames) % 4
+            samples = np.frombuffer(frames[:usable], dtype="<i4").astype(np.float32) / 2147483648.0
+        else:
+            raise ValueError(f"不支持的采样位宽: {width}")
+        channels = max(channels, 1)
+        samples = samples[: samples.size - samples.size % channels]
+        return samples.reshape(-1, channels).T
+
+    @staticmethod
+    def _downmix(samples: np.ndarray) -> np.ndarray:
+        """多声道取平均降混为单声道"""
+        if samples.ndim == 1:
+            return samples
+        if samples.shape[0] == 1:
+            return samples[0]
+        return samples.mean(axis=0)
+
+    @staticmethod
+    def _resample(samples: np.ndarray, source_rate: int, target_rate: int) -> np.ndarray:
+        """重采样到目标采样率，降采样前先做加窗sinc低通滤波防止混叠"""
+        if source_rate == target_rate or samples.size == 0:
+            return samples
+        if target_rate < source_rate:
+            cutoff = target_rate / source_rate / 2
+            taps = np.arange(-32, 33)
+            kernel = np.sinc(2 * cutoff * taps) * np.hamming(taps.size)
+            kernel /= kernel.sum()
+            samples = np.convolve(samples, kernel, mode="same")
+        duration = samples.size / source_rate
+        target_size = int(round(duration * target_rate))
+        source_times = np.arange(samples.size) / source_rate
+        target_times = np.arange(target_size) / target_rate
+        return np.interp(target_times, source_times, samples).astype(np.float32)
+
+    def _trim_silence(self, samples: np.ndarray, rate: int) -> np.ndarray:
+        """按20ms分帧计算RMS，裁掉首尾低于阈值的静音段"""
+        frame_size = max(rate // 50, 1)
+        frame_count = samples.size // frame_size
+        if frame_count == 0:
+            return samples
+        frames = samples[: frame_count * frame_size].reshape(frame_count, frame_size)
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+        voiced = np.nonzero(rms > 10 ** (self.silence_db / 20))[0]
+        if voiced.size == 0:
+            return samples[:0]
+        pad = int(rate * self.silence_pad_ms / 1000)
+        start = max(voiced[0] * frame_size - pad, 0)
+        end = min((voiced[-1] + 1) * frame_size + pad, samples.size)
+        return samples[start:end]
+
+    def _encode(self, samples: np.ndarray, rate: int):
+        """编码为上传格式，返回 (扩展名, MIME类型, 字节数据)"""
+        pcm16 = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+
+        if self.upload_format in ("flac", "opus"):
+            codec, container_format, extension, mime = {
+                "flac": ("flac", "flac", "flac", "audio/flac"),
+                "opus": ("libopus", "ogg", "ogg", "audio/ogg"),
+            }[self.upload_format]
+            buffer = io.BytesIO()
+            with av.open(buffer, mode="w", format=container_format) as container:
+                stream = container.add_stream(codec, rate=rate, layout="mono")
+                frame = av.AudioFrame.from_ndarray(pcm16.reshape(1, -1), format="s16", layout="mono")
+                frame.sample_rate = rate
+                for packet in stream.encode(frame):
+                    container.mux(packet)
+                for packet in stream.encode(None):
+                    container.mux(packet)
+            return extension, mime, buffer.getvalue()
+
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(rate)
+            wav_file.writeframes(pcm16.tobytes())
+        return "wav", "audio/wav", buffer.getvalue()
+
+
+# 创建全局实例
+audio_normalizer = AudioNormalizer()
@@ -1,35 +1,118 @@
 # -*- coding: utf-8 -*-
 import base64
 import json
-from typing import Dict
+from typing import Dict, Optional
 import asyncio
 from datetime import datetime
 import os
-from io import BytesIO
-from PIL import Image
 from dotenv import load_dotenv
 
 # 加载环境变量
 load_dotenv()
 
+
+def detect_image_format(header: bytes) -> Optional[str]:
+    """根据文件头字节探测图片格式
+
+    Args:
+        header: 图片数据的前12个字节
+
+    Returns:
+        格式名称（JPEG/PNG/GIF/WEBP），不支持时返回None
+    """
+    if header[:3] == b"\xff\xd8\xff":
+        return "JPEG"
+    if header[:8] == b"\x89PNG\r\n\x1a\n":
+        return "PNG"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "GIF"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+class ImageUpload:
+    """有界图片接收缓冲区
+
+    声明了大小时预先分配缓冲区，数据块直接写入；收到足够的文件头后立即校验格式，
+    超过声明大小或上限时立即拒绝，不等整张图片接收完。
+    """
+
+    def __init__(self, max_bytes: int, expected_size: Optional[int] = None):
+        if expected_size is not None and not 0 < expected_size <= max_bytes:
+            raise ValueError(f"图片大小 {expected_size} 字节超过限制 {max_bytes} 字节")
+        self.max_bytes = max_bytes
+        self.expected_size = expected_size
+        self.buffer = bytearray(expected_size) if expected_size else bytearray()
+        self.size = 0
+        self.format: Optional[str] = None
+
+    def feed(self, chunk: bytes):
+        """追加一块数据，大小超限或格式不支持时抛出ValueError"""
+        end = self.size + len(chunk)
+        limit = self.expected_size if self.expected_size is not None else self.max_bytes
+        if end > limit:
+            raise ValueError(f"图片大小超过限制 {limit} 字节")
+        if self.expected_size is not None:
+            self.buffer[self.size:end] = chunk
+        else:
+            self.buffer += chunk
+        self.size = end
+        if self.format is None and self.size >= 12:
+            self._check_format()
+
+    def _check_format(self):
+        self.format = detect_image_format(bytes(self.buffer[:12]))
+        if self.format is None:
+            raise ValueError("不支持的图片格式")
+
+    @property
+    def complete(self) -> bool:
+        return self.expected_size is not None and self.size == self.expected_size
+
+    def getbuffer(self) -> memoryview:
+        """返回已接收数据的视图（不复制）"""
+        if self.size == 0:
+            raise ValueError("图片数据为空")
+        if self.format is None:
+            self._check_format()
+        return memoryview(self.buffer)[:self.size]
+
+
 class ImageProcessor:
     def __init__(self):
-        pass
+        # 单张图片的大小上限
+        self.max_bytes = int(float(os.getenv("IMAGE_MAX_MB", "10")) * 1024 * 1024)
+
+    def create_upload(self, expected_size: Optional[int] = None) -> ImageUpload:
+        """创建二进制图片上传缓冲区，声明大小超过上限时抛出ValueError"""
+        return ImageUpload(self.max_bytes, expected_size)
 
     async def process_image_message(self, image_data: dict) -> Dict:
-        """处理图片消息"""
+        """处理图片消息
+
+        image_data 中的 image_bytes 为二进制通道接收的图片数据，否则解码 image 字段的base64字符串
+        """
         try:
             prompt = image_data.get("prompt", None)
-            image_base64 = image_data.get("image", "")
-            if not image_base64:
-                return {"status": "error", "message": "图片数据为空"}
-
-            # 解码base64图片数据
-            try:
-                image_bytes = base64.b64decode(image_base64)
-                print(f"[ImageProcessor] 接收到图片数据，大小: {len(image_bytes)} 字节")
-            except Exception as e:
-                return {"status": "error", "message": f"图片解码失败: {str(e)}"}
+            image_bytes = image_data.get("image_bytes")
+            if image_bytes is None:
+                image_base64 = image_data.get("image", "")
+                if not image_base64:
+                    return {"status": "error", "message": "图片数据为空"}
+
+                # 解码前按base64长度估算大小，并用前16个字符校验文件头
+                if len(image_base64) * 3 // 4 > self.max_bytes:
+                    return {"status": "error", "message": f"图片大小超过限制 {self.max_bytes} 字节"}
+
+                # 解码base64图片数据
+                try:
+                    if detect_image_format(base64.b64decode(image_base64[:16])) is None:
+                        return {"status": "error", "message": "不支持的图片格式"}
+                    image_bytes = base64.b64decode(image_base64)
+                except Exception as e:
+                    return {"status": "error", "message": f"图片解码失败: {str(e)}"}
+            print(f"[ImageProcessor] 接收到图片数据，大小: {len(image_bytes)} 字节")
 
             # 验证图片格式
             if not self._validate_image_format(image_bytes):
@@ -58,21 +141,14 @@ class ImageProcessor:
             print(f"[ImageProcessor] {error_msg}")
             return {"status": "error", "message": error_msg}
 
-    def _validate_image_format(self, image_bytes: bytes) -> bool:
-        """验证图片格式"""
-        try:
-            image = Image.open(BytesIO(image_bytes))
-            # 支持常见图片格式
-            supported_formats = ['JPEG', 'PNG', 'GIF', 'WEBP']
-            if image.format.upper() in supported_formats:
-                print(f"[ImageProcessor] 图片格式验证通过: {image.format}")
-                return True
-            else:
-                print(f"[ImageProcessor] 不支持的图片格式: {image.format}")
-                return False
-        except Exception as e:
-            print(f"[ImageProcessor] 图片格式验证失败: {str(e)}")
+    def _validate_image_format(self, image_bytes) -> bool:
+        """根据文件头验证图片格式，不做完整解码"""
+        image_format = detect_image_format(bytes(image_bytes[:12]))
+        if image_format is None:
+            print("[ImageProcessor] 不支持的图片格式")
             return False
+        print(f"[ImageProcessor] 图片格式验证通过: {image_format}")
+        return True
 
     async def _analyze_image_with_glm4v(self, image_bytes: bytes, llm_service, prompt: str = None) -> Dict:
         """使用GLM-4V-Flash分析图片"""
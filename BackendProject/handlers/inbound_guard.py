@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+入站消息防护模块
+在JSON解析和base64解码之前，按消息类型和客户端做令牌桶限流和帧大小检查
+"""
+import os
+import re
+import time
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 消息以 {"type": "xxx" 开头时，无需解析整条JSON即可取得类型
+TYPE_PREFIX = re.compile(r'\s*\{\s*"type"\s*:\s*"([A-Za-z_]{1,32})"')
+
+# 默认限流（每秒速率/突发容量），binary为二进制帧（图片数据块）
+DEFAULT_RATE_LIMITS = "text:2/6,image:1/3,audio:100/200,control:5/10,binary:200/400,pong:1/5"
+
+# 默认帧大小上限（字节），image按图片上限的base64长度计算
+DEFAULT_FRAME_LIMITS = "text:16384,audio:262144,control:4096,pong:1024,binary:1048576"
+
+
+def parse_limits(spec: str) -> Dict[str, str]:
+    """解析 "类型:值,类型:值" 格式的配置"""
+    limits = {}
+    for item in spec.split(","):
+        if ":" in item:
+            name, value = item.split(":", 1)
+            limits[name.strip()] = value.strip()
+    return limits
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，容量决定允许的突发量"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, now: float, cost: float = 1.0) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class ClientLimits:
+    """单个连接的限流状态"""
+
+    __slots__ = ("total", "by_type", "last_notice")
+
+    def __init__(self, total: TokenBucket):
+        self.total = total
+        self.by_type: Dict[str, TokenBucket] = {}
+        self.last_notice = 0.0
+
+
+class InboundGuard:
+    """入站帧防护：连接总限流、按类型限流和按类型的帧大小上限"""
+
+    def __init__(self):
+        self.rate_limits: Dict[str, Tuple[float, float]] = {}
+        for name, value in parse_limits(os.getenv("WS_RATE_LIMITS", DEFAULT_RATE_LIMITS)).items():
+            rate, _, burst = value.partition("/")
+            self.rate_limits[name] = (float(rate), float(burst or rate))
+        client_rate, _, client_burst = os.getenv("WS_RATE_CLIENT", "150/300").partition("/")
+        self.client_rate = (float(client_rate), float(client_burst or client_rate))
+
+        self.frame_limits = {
+            name: int(value)
+            for name, value in parse_limits(os.getenv("WS_FRAME_LIMITS", DEFAULT_FRAME_LIMITS)).items()
+        }
+        if "image" not in self.frame_limits:
+            image_max = int(float(os.getenv("IMAGE_MAX_MB", "10")) * 1024 * 1024)
+            self.frame_limits["image"] = image_max * 4 // 3 + 4096
+        # type不在开头、无法在解析前确定类型的帧的大小上限，超过时不做JSON解析直接丢弃
+        self.unknown_frame_limit = int(os.getenv("WS_UNKNOWN_FRAME_BYTES", str(self.frame_limits.get("text", 16384))))
+        # 任何帧的绝对上限，超过时直接断开连接
+        self.max_frame_bytes = int(float(os.getenv("WS_MAX_FRAME_MB", "16")) * 1024 * 1024)
+        # 同一连接两次拒绝提示之间的最小间隔，避免错误响应本身被放大
+        self.notice_interval = float(os.getenv("WS_LIMIT_NOTICE_INTERVAL", "1"))
+
+        self.metrics: Dict[str, int] = {"accepted": 0, "oversized_disconnects": 0}
+
+    def create_limits(self) -> ClientLimits:
+        return ClientLimits(TokenBucket(*self.client_rate))
+
+    @staticmethod
+    def sniff_type(data: str) -> Optional[str]:
+        """从帧开头取出消息类型，type不是第一个字段时返回None"""
+        match = TYPE_PREFIX.match(data, 0, 128)
+        return match.group(1) if match else None
+
+    def _reject(self, reason: str, msg_type: str) -> str:
+        key = f"{reason}:{msg_type}"
+        self.metrics[key] = self.metrics.get(key, 0) + 1
+        return reason
+
+    def check_frame(self, limits: ClientLimits, size: int) -> Optional[str]:
+        """
+        检查任意入站帧：绝对大小上限和连接总限流
+
+        Returns:
+            None表示通过，"oversized" 表示应断开连接，"rate_limited" 表示丢弃该帧
+        """
+        if size > self.max_frame_bytes:
+            self.metrics["oversized_disconnects"] += 1
+            return "oversized"
+        if not limits.total.consume(time.monotonic()):
+            return self._reject("rate_limited", "client")
+        return None
+
+    def check_type(self, limits: ClientLimits, msg_type: str, size: int) -> Optional[str]:
+        """
+        按消息类型检查帧大小和限流
+
+        Returns:
+            None表示通过，否则为拒绝原因（frame_too_large/rate_limited）
+        """
+        max_size = self.frame_limits.get(msg_type)
+        if max_size is not None and size > max_size:
+            return self._reject("frame_too_large", msg_type)
+        limit = self.rate_limits.get(msg_type)
+        if limit is not None:
+            bucket = limits.by_type.get(msg_type)
+            if bucket is None:
+                bucket = limits.by_type[msg_type] = TokenBucket(*limit)
+            if not bucket.consume(time.monotonic()):
+                return self._reject("rate_limited", msg_type)
+        self.metrics["accepted"] += 1
+        return None
+
+    def check_unknown(self, size: int) -> Optional[str]:
+        """无法从帧开头取得类型时，在JSON解析之前按较小的上限检查帧大小"""
+        if size > self.unknown_frame_limit:
+            return self._reject("frame_too_large", "unknown")
+        return None
+
+    def should_notify(self, limits: ClientLimits) -> bool:
+        """限制拒绝提示的发送频率"""
+        now = time.monotonic()
+        if now - limits.last_notice < self.notice_interval:
+            return False
+        limits.last_notice = now
+        return True
+
+    def get_metrics(self) -> Dict[str, int]:
+        """获取通过和按原因、类型统计的拒绝次数"""
+        return dict(self.metrics)
+
+
+# 创建全局实例
+inbound_guard = InboundGuard()
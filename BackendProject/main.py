@@ -1,18 +1,40 @@
 # -*- coding: utf-8 -*-
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Depends, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict
+from typing import Dict, Optional, Set, Tuple
+from contextvars import ContextVar
+from datetime import datetime
+import asyncio
+import base64
+import hmac
+import ipaddress
 import os
 import json
+import time
+import uuid
 from dotenv import load_dotenv
-from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
 import emoji
 
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart 0.0.13 之前的版本
+    from multipart.multipart import MultipartParser, parse_options_header
+
 from handlers.audio_handler import audio_processor, message_parser
-from handlers.image_handler import image_processor
+from handlers.audio_normalizer import audio_normalizer
+from handlers.image_handler import image_processor, ImageUpload
+from handlers.inbound_guard import inbound_guard
 from services.llm_service import llm_service
+from services.history_service import ChatHistory, ROLE_USER, ROLE_ASSISTANT
 from services.http_service import http_service
+from services.asr_service import asr_service
+from services.storage_service import audio_storage
+from services.tts_pool import tts_pool
+from services.profiling_service import loop_monitor, profiler
+from services.load_shedder import load_shedder
+from services.usage_service import usage_tracker, current_client
 
 # 加载环境变量
 load_dotenv()
@@ -29,20 +51,352 @@ app.add_middleware(
 )
 
 
+class StreamFrame(str):
+    """流式音频的控制帧（start/end），与音频数据帧一样按顺序发送，不会因队列满被丢弃"""
+
+
+class SendQueue(asyncio.Queue):
+    """连接的发送队列，队列满时只淘汰普通文本帧"""
+
+    def drop_oldest_text(self) -> bool:
+        """丢弃最早的普通文本帧；流式音频的数据帧和控制帧保留，丢弃会破坏MP3流"""
+        for index, frame in enumerate(self._queue):
+            if not isinstance(frame, (bytes, StreamFrame)):
+                del self._queue[index]
+                return True
+        return False
+
+
+class Connection:
+    """单个WebSocket连接的状态：发送队列、写任务、心跳时间和挂起任务"""
+
+    __slots__ = (
+        "websocket", "client_id", "queue", "writer_task", "tasks", "last_seen", "dropped", "closed",
+        "inbox", "turn_task", "upload", "limits",
+    )
+
+    def __init__(self, websocket: WebSocket, client_id: str, queue_size: int, inbox_size: int = 256):
+        self.websocket = websocket
+        self.client_id = client_id
+        # 有界发送队列，由写任务顺序发送，慢客户端不会阻塞其他连接
+        self.queue: SendQueue = SendQueue(maxsize=queue_size)
+        self.writer_task: Optional[asyncio.Task] = None
+        # 与连接绑定的挂起任务，连接释放时一并取消
+        self.tasks: Set[asyncio.Task] = set()
+        self.last_seen = time.monotonic()
+        self.dropped = 0
+        self.closed = False
+        # 接收循环解析后的消息队列，由分发任务按顺序处理
+        self.inbox: asyncio.Queue = asyncio.Queue(maxsize=inbox_size)
+        # 当前进行中的对话轮次任务（LLM + TTS），新的用户输入会取消它
+        self.turn_task: Optional[asyncio.Task] = None
+        # 进行中的二进制图片上传 (ImageUpload, 图片消息参数)
+        self.upload: Optional[Tuple[ImageUpload, dict]] = None
+        # 入站限流状态
+        self.limits = inbound_guard.create_limits()
+
+
+class TurnState:
+    """一轮对话的上游调用统计，用于计算被打断时浪费的调用"""
+
+    __slots__ = ("upstream_calls", "aborted_calls", "upstream_ms")
+
+    def __init__(self):
+        self.upstream_calls = 0
+        self.aborted_calls = 0
+        self.upstream_ms = 0.0
+
+
+# 当前任务所属的对话轮次
+current_turn: ContextVar[Optional[TurnState]] = ContextVar("current_turn", default=None)
+
+
+async def track_upstream(awaitable, sample_latency: bool = True):
+    """等待一次上游调用（LLM/TTS），并计入当前轮次的统计
+
+    sample_latency 为False时不计入降级控制的上游延迟（如耗时取决于客户端接收速度的流式推送）
+    """
+    turn = current_turn.get()
+    start = time.perf_counter()
+    try:
+        result = await awaitable
+    except asyncio.CancelledError:
+        if turn is not None:
+            turn.aborted_calls += 1
+            turn.upstream_ms += (time.perf_counter() - start) * 1000
+        raise
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if sample_latency:
+        load_shedder.record_upstream(elapsed_ms)
+    if turn is not None:
+        turn.upstream_calls += 1
+        turn.upstream_ms += elapsed_ms
+    return result
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        # 以client_id为键的连接注册表
+        self.active_connections: Dict[str, Connection] = {}
         # 存储每个客户端的消息历史记录
-        self.message_history: Dict[str, List[BaseMessage]] = {}
+        self.message_history: Dict[str, ChatHistory] = {}
+        self.send_queue_size = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+        self.send_timeout = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+        # 发送队列满时的策略: drop_oldest（丢弃最旧消息）、drop_new（丢弃新消息）、disconnect（断开连接）
+        self.slow_consumer_policy = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+        # 心跳间隔和空闲超时（秒），超时未收到任何消息（包括pong）的连接会被回收
+        self.inbox_size = int(os.getenv("WS_INBOX_SIZE", "256"))
+        self.ping_interval = float(os.getenv("WS_PING_INTERVAL", "20"))
+        self.idle_timeout = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+        # 广播消息先进入共享队列，由分发任务扇出到各连接，发送方无需等待
+        self.broadcast_queue: Optional[asyncio.Queue] = None
+        self.fanout_task: Optional[asyncio.Task] = None
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        self.metrics: Dict[str, int] = {
+            "frames_sent": 0,
+            "frames_dropped": 0,
+            "slow_disconnects": 0,
+            "send_errors": 0,
+            "idle_reaped": 0,
+            "turns_started": 0,
+            "turns_cancelled": 0,
+            "wasted_upstream_calls": 0,
+            "aborted_upstream_calls": 0,
+            "wasted_upstream_ms": 0,
+        }
+
+    def _start_background_tasks(self):
+        if self.fanout_task is None:
+            self.broadcast_queue = asyncio.Queue()
+            self.fanout_task = asyncio.create_task(self._fanout())
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self._heartbeat())
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, client_id: str = "") -> Connection:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = Connection(websocket, client_id, self.send_queue_size, self.inbox_size)
+        connection.writer_task = asyncio.create_task(self._writer(connection))
+        websocket.state.connection = connection
+
+        # 同一client_id重复连接时，替换旧连接（保留历史记录）
+        previous = self.active_connections.get(client_id)
+        if previous is not None:
+            print(f"[ConnectionManager] 客户端 {client_id} 重复连接，关闭旧连接")
+            self._close_connection(previous)
+            asyncio.create_task(self._close_quietly(previous.websocket))
+        self.active_connections[client_id] = connection
+        self._start_background_tasks()
+        return connection
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def send_personal_message(self, message: str, audio: str, websocket: WebSocket, msg_type: int = 1, animation_index: int = None, should_take_photo: bool = None, prompt: str = None):
+        connection = self._connection_for(websocket)
+        if connection is None or connection.closed:
+            return
+        self._release(connection)
+
+    def get_connection(self, client_id: str) -> Optional[Connection]:
+        return self.active_connections.get(client_id)
+
+    @staticmethod
+    def _connection_for(websocket: WebSocket) -> Optional[Connection]:
+        return getattr(websocket.state, "connection", None)
+
+    def touch(self, websocket: WebSocket):
+        """记录连接的最近活动时间"""
+        connection = self._connection_for(websocket)
+        if connection is not None:
+            connection.last_seen = time.monotonic()
+
+    def add_task(self, websocket: WebSocket, task: asyncio.Task):
+        """登记与连接绑定的任务，任务结束后自动移除"""
+        connection = self._connection_for(websocket)
+        if connection is None or connection.closed:
+            task.cancel()
+            return
+        connection.tasks.add(task)
+        task.add_done_callback(connection.tasks.discard)
+
+    def start_turn(self, websocket: WebSocket, handler, *args):
+        """以受监督任务的方式启动一轮对话，同时取消进行中的上一轮"""
+        connection = self._connection_for(websocket)
+        if connection is None or connection.closed:
+            return
+        self.cancel_turn(websocket)
+        task = asyncio.create_task(self._run_turn(connection, handler, *args))
+        connection.turn_task = task
+        self.metrics["turns_started"] += 1
+        self.add_task(websocket, task)
+
+    def cancel_turn(self, websocket: WebSocket) -> bool:
+        """取消进行中的对话轮次（包括尚未完成的TTS），返回是否有被取消的轮次"""
+        connection = self._connection_for(websocket)
+        if connection is None or connection.turn_task is None or connection.turn_task.done():
+            return False
+        connection.turn_task.cancel()
+        connection.turn_task = None
+        return True
+
+    async def _run_turn(self, connection: Connection, handler, *args):
+        turn = TurnState()
+        current_turn.set(turn)
+        current_client.set(connection.client_id)
+        load_shedder.turn_started()
+        try:
+            await handler(connection.websocket, connection.client_id, *args)
+        except asyncio.CancelledError:
+            # 被打断的轮次：已完成的上游调用结果被丢弃，进行中的调用被中止
+            self.metrics["turns_cancelled"] += 1
+            self.metrics["wasted_upstream_calls"] += turn.upstream_calls
+            self.metrics["aborted_upstream_calls"] += turn.aborted_calls
+            self.metrics["wasted_upstream_ms"] += int(turn.upstream_ms)
+            print(
+                f"[ConnectionManager] 客户端 {connection.client_id} 的对话轮次被打断，"
+                f"浪费上游调用 {turn.upstream_calls} 次，中止 {turn.aborted_calls} 次"
+            )
+            raise
+        except Exception as e:
+            print(f"[ConnectionManager] 客户端 {connection.client_id} 的对话轮次异常: {str(e)}")
+            await self.send_personal_message(f"AI 错误: {str(e)}", "", connection.websocket, msg_type=1)
+        finally:
+            load_shedder.turn_finished()
+            if connection.turn_task is asyncio.current_task():
+                connection.turn_task = None
+
+    def _close_connection(self, connection: Connection):
+        """取消连接的写任务和挂起任务"""
+        connection.closed = True
+        current = asyncio.current_task()
+        for task in list(connection.tasks):
+            if task is not current:
+                task.cancel()
+        connection.tasks.clear()
+        if connection.writer_task is not None and connection.writer_task is not current:
+            connection.writer_task.cancel()
+        # 分发任务已取消，清空待处理消息，唤醒阻塞在入队上的接收循环
+        while not connection.inbox.empty():
+            connection.inbox.get_nowait()
+
+    def _release(self, connection: Connection):
+        """释放连接及其客户端的全部状态：任务、历史记录、音频缓冲"""
+        self._close_connection(connection)
+        # 已被新连接替换时，客户端状态归新连接所有
+        if self.active_connections.get(connection.client_id) is connection:
+            del self.active_connections[connection.client_id]
+            self.clear_message_history(connection.client_id)
+            audio_processor.release(connection.client_id)
+
+    async def _heartbeat(self):
+        """心跳任务：定期发送ping并回收空闲超时的连接"""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            ping = json.dumps({"type": "ping", "data": {"timestamp": datetime.now().isoformat()}})
+            for connection in list(self.active_connections.values()):
+                if now - connection.last_seen > self.idle_timeout:
+                    self.metrics["idle_reaped"] += 1
+                    print(f"[ConnectionManager] 客户端 {connection.client_id} 心跳超时，回收连接")
+                    self._release(connection)
+                    asyncio.create_task(self._close_quietly(connection.websocket))
+                else:
+                    self._enqueue(connection, ping)
+
+    async def _writer(self, connection: Connection):
+        """连接的写任务：按顺序发送队列中的帧"""
+        try:
+            while True:
+                frame = await connection.queue.get()
+                if isinstance(frame, bytes):
+                    await asyncio.wait_for(connection.websocket.send_bytes(frame), self.send_timeout)
+                else:
+                    await asyncio.wait_for(connection.websocket.send_text(frame), self.send_timeout)
+                self.metrics["frames_sent"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # 发送失败或超时说明连接已不可用，停止向其发送
+            self.metrics["send_errors"] += 1
+            print(f"[ConnectionManager] 客户端 {connection.client_id} 发送失败: {type(e).__name__} {str(e)}")
+            self._release(connection)
+            asyncio.create_task(self._close_quietly(connection.websocket))
+
+    def _enqueue(self, connection: Connection, frame: str) -> bool:
+        """将已编码的帧放入连接的发送队列，队列满时按策略处理慢客户端"""
+        if connection.closed:
+            return False
+        try:
+            connection.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        connection.dropped += 1
+        self.metrics["frames_dropped"] += 1
+        if self.slow_consumer_policy == "disconnect":
+            self.metrics["slow_disconnects"] += 1
+            print(f"[ConnectionManager] 客户端 {connection.client_id} 发送队列已满，断开连接")
+            self._release(connection)
+            asyncio.create_task(self._close_quietly(connection.websocket))
+            return False
+        if self.slow_consumer_policy == "drop_oldest" and connection.queue.drop_oldest_text():
+            connection.queue.put_nowait(frame)
+            return True
+        # 队列中全是流式音频帧时丢弃新帧
+        return False
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket):
+        try:
+            await websocket.close(code=1008)
+        except Exception:
+            pass
+
+    async def _fanout(self):
+        """广播分发任务：同一帧对象共享给所有连接的发送队列"""
+        while True:
+            frame = await self.broadcast_queue.get()
+            for connection in list(self.active_connections.values()):
+                self._enqueue(connection, frame)
+
+    async def send_text(self, message: str, websocket: WebSocket):
+        """发送文本帧（进入连接的发送队列）"""
+        connection = self._connection_for(websocket)
+        if connection is not None:
+            self._enqueue(connection, message)
+
+    async def send_bytes(self, data: bytes, websocket: WebSocket) -> bool:
+        """发送二进制帧（流式音频），队列满时等待而不是丢弃，超时视为慢客户端"""
+        return await self._put_ordered(data, websocket)
+
+    async def send_stream_json(self, data: dict, websocket: WebSocket) -> bool:
+        """发送流式音频的控制帧，与音频数据帧一样等待入队，不会被丢弃"""
+        return await self._put_ordered(StreamFrame(json.dumps(data)), websocket)
+
+    def send_stream_json_nowait(self, data: dict, websocket: WebSocket) -> bool:
+        """不等待入队地发送流式音频的控制帧（任务被取消时使用），队列满且无法淘汰文本帧时丢弃"""
+        connection = self._connection_for(websocket)
+        if connection is None:
+            return False
+        return self._enqueue(connection, StreamFrame(json.dumps(data)))
+
+    async def _put_ordered(self, frame, websocket: WebSocket) -> bool:
+        connection = self._connection_for(websocket)
+        if connection is None or connection.closed:
+            return False
+        try:
+            await asyncio.wait_for(connection.queue.put(frame), self.send_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.metrics["slow_disconnects"] += 1
+            print(f"[ConnectionManager] 客户端 {connection.client_id} 接收音频过慢，断开连接")
+            self._release(connection)
+            asyncio.create_task(self._close_quietly(connection.websocket))
+            return False
+
+    async def send_json(self, data: dict, websocket: WebSocket):
+        """编码一次后发送JSON帧"""
+        await self.send_text(json.dumps(data), websocket)
+
+    async def send_personal_message(self, message: str, audio: str, websocket: WebSocket, msg_type: int = 1, animation_index: int = None, should_take_photo: bool = None, prompt: str = None, lipsync: dict = None, audio_stream: str = None):
         """发送个人消息，支持多种类型
 
         Args:
@@ -51,6 +405,8 @@ class ConnectionManager:
             msg_type: 消息类型（1:文字，2:图片，3:音频）
             animation_index: 动画序号（可选）
             should_take_photo: 是否需要拍照（可选）
+            lipsync: 音频的口型包络（可选）
+            audio_stream: 随后以二进制帧推送的音频流ID（可选）
         """
         message_obj = {
             "type": msg_type,
@@ -65,22 +421,36 @@ class ConnectionManager:
         if prompt is not None:
             message_obj["prompt"] = prompt
         print(f"[send_personal_message] 发送的消息内容: {message_obj}")
+        if lipsync is not None:
+            message_obj["lipsync"] = lipsync
+        if audio_stream is not None:
+            message_obj["audio_stream"] = audio_stream
 
-        await websocket.send_text(json.dumps(message_obj))
+        await self.send_json(message_obj, websocket)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        """广播消息，发送方只做一次入队，耗时与连接数无关"""
+        if self.broadcast_queue is not None:
+            self.broadcast_queue.put_nowait(message)
+
+    def get_metrics(self) -> Dict[str, int]:
+        """获取连接数、排队帧数和慢客户端处理统计"""
+        return {
+            **self.metrics,
+            "connections": len(self.active_connections),
+            "queued_frames": sum(c.queue.qsize() for c in self.active_connections.values()),
+        }
 
-    def add_message_to_history(self, client_id: str, message: BaseMessage):
+    def add_message_to_history(self, client_id: str, role: int, text: str):
         """添加消息到指定客户端的历史记录"""
-        if client_id not in self.message_history:
-            self.message_history[client_id] = []
-        self.message_history[client_id].append(message)
+        history = self.message_history.get(client_id)
+        if history is None:
+            history = self.message_history[client_id] = ChatHistory()
+        history.append(role, text)
 
-    def get_message_history(self, client_id: str) -> List[BaseMessage]:
+    def get_message_history(self, client_id: str) -> ChatHistory:
         """获取指定客户端的消息历史记录"""
-        return self.message_history.get(client_id, [])
+        return self.message_history.get(client_id) or ChatHistory()
 
     def clear_message_history(self, client_id: str):
         """清除指定客户端的消息历史记录"""
@@ -101,6 +471,210 @@ def remove_emojis(text: str) -> str:
 
 manager = ConnectionManager()
 
+# 内存快照中输出连接和音频缓冲的规模，便于对照内存增长
+profiler.register_inspector("connection_manager", lambda: {
+    "connections": len(manager.active_connections),
+    "history_clients": len(manager.message_history),
+    "history_messages": sum(len(history) for history in list(manager.message_history.values())),
+    "tasks": sum(len(c.tasks) for c in list(manager.active_connections.values())),
+})
+profiler.register_inspector("audio_processor", lambda: {
+    "buffers": len(audio_processor.audio_buffers),
+    "chunks": sum(len(chunks) for chunks in list(audio_processor.audio_buffers.values())),
+    "bytes": sum(len(chunk) for chunks in list(audio_processor.audio_buffers.values()) for chunk in chunks),
+})
+profiler.register_inspector("usage_tracker", lambda: {
+    "clients": len(usage_tracker.clients),
+    "usage_keys": len(usage_tracker.totals),
+    "pending_records": usage_tracker.pending,
+})
+
+# 回复音频的交付方式: url（TTS服务文件地址）、ws（二进制帧推送）、http（后端分块流式接口）
+TTS_DELIVERY = os.getenv("TTS_DELIVERY", "url")
+# 前端访问后端流式接口的地址前缀（经nginx的 /api/ 代理）
+TTS_STREAM_BASE_URL = os.getenv("TTS_STREAM_BASE_URL", "/api")
+TTS_STREAM_TTL = float(os.getenv("TTS_STREAM_TTL", "60"))
+# HTTP流式交付时待领取的合成文本: token -> (文本, 过期时间)
+pending_tts_streams: Dict[str, Tuple[str, float]] = {}
+
+
+async def prepare_reply_audio(clean_text: str, delivery: str) -> Tuple[str, Optional[dict], Optional[str]]:
+    """按交付方式准备回复音频
+
+    Args:
+        clean_text: 已移除表情符号的回复文本
+        delivery: 交付方式（url/ws/http）
+
+    Returns:
+        (音频URL, 口型包络, 音频流ID)
+    """
+    if delivery == "ws":
+        return "", None, uuid.uuid4().hex
+
+    if delivery == "http":
+        now = time.monotonic()
+        for token in [t for t, (_, expires) in pending_tts_streams.items() if expires < now]:
+            del pending_tts_streams[token]
+        token = uuid.uuid4().hex
+        pending_tts_streams[token] = (clean_text, now + TTS_STREAM_TTL)
+        return f"{TTS_STREAM_BASE_URL}/tts/stream/{token}", None, None
+
+    audio_url, lipsync = await track_upstream(http_service.generate_tts_audio_with_lipsync(clean_text))
+    return audio_url, lipsync, None
+
+
+async def stream_reply_audio(websocket: WebSocket, stream_id: str, clean_text: str):
+    """以二进制帧推送回复音频：start控制帧、若干音频数据帧、end控制帧
+
+    流式合成没有返回任何数据时改为 url 方式，发送带音频地址的fallback控制帧；
+    对话被打断或推送出错时发送abort控制帧，客户端据此丢弃已收到的不完整音频
+    """
+    chunks = http_service.stream_tts_audio(clean_text)
+    try:
+        first = await anext(chunks, None)
+        if first is None:
+            print(f"[stream_reply_audio] 流式合成无数据，改为音频URL: {stream_id}")
+            audio_url, lipsync = await http_service.generate_tts_audio_with_lipsync(clean_text)
+            await manager.send_stream_json({
+                "type": "audio_stream",
+                "data": {"stream_id": stream_id, "event": "fallback", "audio_url": audio_url, "lipsync": lipsync}
+            }, websocket)
+            return
+
+        await manager.send_stream_json({
+            "type": "audio_stream",
+            "data": {"stream_id": stream_id, "event": "start", "mime": "audio/mpeg"}
+        }, websocket)
+        total = 0
+        chunk = first
+        while chunk is not None:
+            if not await manager.send_bytes(chunk, websocket):
+                return
+            total += len(chunk)
+            chunk = await anext(chunks, None)
+        await manager.send_stream_json({
+            "type": "audio_stream",
+            "data": {"stream_id": stream_id, "event": "end", "bytes": total}
+        }, websocket)
+    except (asyncio.CancelledError, Exception) as e:
+        reason = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+        manager.send_stream_json_nowait({
+            "type": "audio_stream",
+            "data": {"stream_id": stream_id, "event": "abort", "reason": reason}
+        }, websocket)
+        raise
+    finally:
+        await chunks.aclose()
+
+
+async def prepare_turn_audio(ai_response: str, msg_data: dict) -> Tuple[str, Optional[dict], Optional[str], str]:
+    """按消息参数为回复准备语音，未开启语音或负载降级为只回复文字时返回空结果
+
+    Returns:
+        (音频URL, 口型包络, 音频流ID, 移除表情符号后的文本)
+    """
+    if os.getenv("ISAUDIO", False) == False or not msg_data.get("is_audio", False):
+        return "", None, None, ""
+    if load_shedder.policy().text_only:
+        return "", None, None, ""
+    clean_text = remove_emojis(ai_response)
+    delivery = msg_data.get("audio_delivery", TTS_DELIVERY)
+    audio_url, lipsync, audio_stream = await prepare_reply_audio(clean_text, delivery)
+    return audio_url, lipsync, audio_stream, clean_text
+
+
+# 对话的系统提示词
+CHAT_SYSTEM_PROMPT = """你叫小凡，是一个知心朋友，可爱的小女生，要有同理心。
+            你的性格特点：
+            - 温柔体贴，善于倾听
+            - 说话亲切自然，像好朋友一样聊天
+            - 能够理解对方的情绪，给予安慰和支持
+            - 回复时使用轻松活泼的语气，适当使用表情符号
+            - 避免过于正式或机械的表达
+
+           请记住，你是一个可爱的小女生，你的主要任务是与用户进行轻松、自然的对话。
+           不要使用任何专业术语或复杂的表达，尽量使用简单、通俗易懂的语言。
+           请尽量使用表情符号来增加对话的趣味性。请始终保持这个角色设定，用温暖、真诚的态度与用户交流。
+
+           """
+
+
+async def generate_text_reply(history: ChatHistory, msg_data: dict, emit=None) -> dict:
+    """
+    生成一轮文本对话的回复、动画索引和拍照判断，WebSocket和HTTP接口共用
+
+    Args:
+        history: 对话历史（不含本轮消息）
+        msg_data: 消息参数（content/model/has_image）
+        emit: 事件回调 async (event, data)，提供时流式返回回复内容并逐项推送结果
+
+    Returns:
+        {"reply": 回复内容, "animation_index": 动画索引, "should_take_photo": 是否需要拍照}
+
+    负载较高时按降级控制的当前级别使用默认动画、跳过拍照判断、缩短历史或切换快速模型；
+    当前客户端的用量接近额度时切换快速模型，超过额度时抛出BudgetExceeded
+    """
+    text = msg_data.get("content", "")
+    model = msg_data.get("model", "Hiyori")
+    policy = load_shedder.policy()
+    window = policy.history_window
+    # 客户端用量超过额度时抛出BudgetExceeded，接近额度时切换到快速模型
+    fast = usage_tracker.enforce() or policy.fast_model
+
+    # 调用大模型服务获取回复
+    if emit is None:
+        ai_response = await track_upstream(
+            llm_service.chat(history, text, CHAT_SYSTEM_PROMPT, window=window, fast=fast)
+        )
+    else:
+        parts = []
+        async for delta in llm_service.chat_stream(
+            history, text, CHAT_SYSTEM_PROMPT, window=window, fast=fast
+        ):
+            parts.append(delta)
+            await emit("delta", {"text": delta})
+        ai_response = "".join(parts)
+        await emit("reply", {"text": ai_response})
+
+    # 调用大模型服务获取动画索引
+    if policy.default_animation:
+        animation_index = load_shedder.default_animation_index
+    else:
+        animation_index = int(await track_upstream(llm_service.get_animation_index(history, text, model, window)))
+    if emit is not None:
+        await emit("animation", {"animation_index": animation_index})
+
+    should_take_photo = False
+    if not msg_data.get("has_image", False) and not policy.skip_photo:
+        # 调用大模型服务判断是否需要拍照
+        should_take_photo = await track_upstream(llm_service.should_take_photo(history, text, window))
+        print(f"[generate_text_reply] 是否需要拍照: {should_take_photo}")
+    if emit is not None:
+        await emit("photo", {"should_take_photo": should_take_photo})
+
+    return {"reply": ai_response, "animation_index": animation_index, "should_take_photo": should_take_photo}
+
+
+@app.on_event("startup")
+async def on_startup():
+    await asr_service.start()
+    audio_storage.start()
+    tts_pool.start()
+    usage_tracker.start()
+    loop_monitor.start()
+    load_shedder.set_lag_source(loop_monitor.recent_lag_ms)
+    load_shedder.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await asr_service.close()
+    await audio_storage.close()
+    await tts_pool.close()
+    await usage_tracker.close()
+    await loop_monitor.close()
+    await load_shedder.close()
+
 
 @app.get("/")
 async def root():
@@ -112,52 +686,748 @@ async def say_hello(name: str):
     return {"message": f"Hello {name}"}
 
 
+@app.get("/tts/stream/{token}")
+async def tts_stream(token: str):
+    """分块返回回复音频（HTTP流式交付方式），token一次有效"""
+    entry = pending_tts_streams.pop(token, None)
+    if entry is None or entry[1] < time.monotonic():
+        raise HTTPException(status_code=404, detail="音频流不存在或已过期")
+    # 先取第一块数据，合成失败时返回错误状态而不是空的200响应
+    chunks = http_service.stream_tts_audio(entry[0])
+    first = await anext(chunks, None)
+    if first is None:
+        await chunks.aclose()
+        raise HTTPException(status_code=502, detail="语音合成失败")
+
+    async def body():
+        try:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(body(), media_type="audio/mpeg")
+
+
+@app.get("/metrics/audio")
+async def audio_metrics():
+    """音频规整前后的平均上传字节数和识别耗时"""
+    return audio_normalizer.get_stats()
+
+
+@app.get("/metrics/storage")
+async def storage_metrics():
+    """audio_files目录的磁盘占用和清理统计"""
+    return audio_storage.get_metrics()
+
+
+@app.get("/metrics/tts")
+async def tts_metrics():
+    """各TTS实例的排队长度、健康状态和请求统计"""
+    return tts_pool.get_metrics()
+
+
+@app.get("/metrics/inbound")
+async def inbound_metrics():
+    """入站限流、帧大小和音频缓冲超限的拒绝统计"""
+    return {"guard": inbound_guard.get_metrics(), "audio": audio_processor.get_metrics()}
+
+
+@app.get("/metrics/load")
+async def load_metrics():
+    """降级控制的当前级别、负载信号和各级别累计停留时间"""
+    return load_shedder.get_metrics()
+
+
+@app.get("/metrics/connections")
+async def connection_metrics():
+    """WebSocket连接数、发送队列和慢客户端统计"""
+    return manager.get_metrics()
+
+
+# 管理接口令牌，未配置时 /admin 下的接口不可用
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def require_admin(x_admin_token: str = Header("")):
+    """校验管理接口令牌（请求头 X-Admin-Token）"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="管理接口未启用")
+    if not hmac.compare_digest(x_admin_token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="管理令牌无效")
+
+
+# 用量统计会列出所有客户端标识，只对管理员开放
+@app.get("/metrics/usage", dependencies=[Depends(require_admin)])
+async def usage_metrics(top: int = 10):
+    """按调用类型和模型统计的token用量、耗时和费用，以及统计窗口内用量最多的客户端"""
+    return usage_tracker.get_metrics(top)
+
+
+@app.get("/metrics/usage/{client_id}", dependencies=[Depends(require_admin)])
+async def client_usage_metrics(client_id: str):
+    """单个客户端在统计窗口内的用量、额度状态和按调用类型的累计值"""
+    usage = usage_tracker.get_client_usage(client_id)
+    if usage is None:
+        raise HTTPException(status_code=404, detail="没有该客户端的用量记录")
+    return usage
+
+
+@app.get("/admin/loop", dependencies=[Depends(require_admin)])
+async def loop_metrics():
+    """事件循环延迟直方图和最近的阻塞事件（含调用栈）"""
+    return loop_monitor.get_metrics()
+
+
+@app.get("/admin/profile/cpu", dependencies=[Depends(require_admin)])
+async def profile_cpu(seconds: float = 5.0, interval_ms: float = 5.0):
+    """采样指定时长内所有线程的调用栈，返回折叠栈文本（用于生成火焰图）"""
+    try:
+        stacks = await profiler.capture_cpu(seconds, interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(stacks)
+
+
+@app.get("/admin/profile/memory", dependencies=[Depends(require_admin)])
+async def profile_memory(top: int = 20, key: str = "lineno"):
+    """首次调用开始tracemalloc跟踪，之后返回相对上一次调用增长最多的内存分配位置"""
+    if key not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="key 只能是 lineno、filename 或 traceback")
+    return await asyncio.to_thread(profiler.memory_snapshot, top, key)
+
+
+@app.delete("/admin/profile/memory", dependencies=[Depends(require_admin)])
+async def stop_profile_memory():
+    """停止tracemalloc跟踪"""
+    profiler.stop_memory()
+    return {"status": "success", "message": "已停止内存跟踪"}
+
+
+def request_content_length(request: Request) -> Optional[int]:
+    """解析Content-Length请求头，格式错误时返回400"""
+    value = request.headers.get("content-length")
+    if value is None:
+        return None
+    try:
+        length = int(value)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPException(status_code=400, detail="Content-Length格式错误")
+    return length
+
+
+def limit_request_body(request: Request, max_bytes: int) -> Request:
+    """
+    限制请求体大小：Content-Length超限时立即拒绝，未声明长度（分块传输）时在读取过程中累计，超限返回413
+
+    Returns:
+        读取请求体时计数的新Request，json()、form()和stream()都经过该限制
+    """
+    detail = f"请求体超过限制 {max_bytes} 字节"
+    length = request_content_length(request)
+    if length is not None and length > max_bytes:
+        raise HTTPException(status_code=413, detail=detail)
+    receive = request.receive
+    received = 0
+
+    async def limited_receive():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                raise HTTPException(status_code=413, detail=detail)
+        return message
+
+    return Request(request.scope, limited_receive)
+
+
+async def read_image_file(file) -> ImageUpload:
+    """分块读取上传的图片文件到有界缓冲区，大小超限或格式不支持时抛出ValueError"""
+    upload = image_processor.create_upload(file.size)
+    while chunk := await file.read(64 * 1024):
+        upload.feed(chunk)
+    return upload
+
+
+async def read_multipart_image(request: Request, file_field: str = "file", max_fields: int = 8) -> Tuple[dict, Optional[ImageUpload]]:
+    """
+    流式解析multipart请求，图片字段的数据直接写入有界缓冲区，不缓存到磁盘
+
+    Returns:
+        (普通字段, 图片上传缓冲区)，请求中没有图片字段时缓冲区为None；大小超限、格式不支持或字段过多时抛出ValueError
+    """
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise ValueError("multipart请求缺少boundary")
+
+    fields: Dict[str, str] = {}
+    part = {"header_field": b"", "header_value": b"", "name": None, "is_file": False, "value": bytearray()}
+    upload: Optional[ImageUpload] = None
+
+    def on_part_begin():
+        part.update(header_field=b"", header_value=b"", name=None, is_file=False, value=bytearray())
+
+    def on_header_field(data: bytes, start: int, end: int):
+        part["header_field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        part["header_value"] += data[start:end]
+
+    def on_header_end():
+        if part["header_field"].lower() == b"content-disposition":
+            _, options = parse_options_header(part["header_value"])
+            part["name"] = options.get(b"name", b"").decode("utf-8", "replace")
+            part["is_file"] = b"filename" in options
+        part["header_field"] = part["header_value"] = b""
+
+    def on_headers_finished():
+        nonlocal upload
+        if part["is_file"] and part["name"] == file_field:
+            if upload is not None:
+                raise ValueError("只能上传一个文件")
+            upload = image_processor.create_upload()
+        elif len(fields) >= max_fields:
+            raise ValueError(f"表单字段过多，最多 {max_fields} 个")
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if part["is_file"]:
+            # 其他文件字段直接忽略
+            if part["name"] == file_field:
+                upload.feed(data[start:end])
+            return
+        part["value"] += data[start:end]
+        if len(part["value"]) > 64 * 1024:
+            raise ValueError("表单字段过长")
+
+    def on_part_end():
+        if not part["is_file"] and part["name"]:
+            fields[part["name"]] = part["value"].decode("utf-8", "replace")
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    async for chunk in request.stream():
+        parser.write(chunk)
+    parser.finalize()
+    return fields, upload
+
+
+@app.post("/image/{client_id}")
+async def upload_image(client_id: str, request: Request):
+    """
+    HTTP图片上传，分析结果通过该客户端的WebSocket连接返回
+
+    支持 multipart/form-data（file字段，另可带prompt、is_audio字段）或直接以图片作为请求体（参数放在查询字符串中）
+    """
+    connection = manager.get_connection(client_id)
+    if connection is None:
+        raise HTTPException(status_code=404, detail="客户端未连接")
+    # 与WebSocket图片消息共用该客户端的图片限流
+    if inbound_guard.check_type(connection.limits, "image", 0):
+        raise HTTPException(status_code=429, detail=LIMIT_MESSAGES["rate_limited"])
+
+    request = limit_request_body(request, image_processor.max_bytes + 64 * 1024)
+    content_type = request.headers.get("content-type", "")
+    try:
+        if content_type.startswith("multipart/form-data"):
+            msg_data, upload = await read_multipart_image(request)
+            if upload is None:
+                raise HTTPException(status_code=400, detail="缺少file字段")
+        else:
+            msg_data = dict(request.query_params)
+            upload = image_processor.create_upload(request_content_length(request) or None)
+            async for chunk in request.stream():
+                upload.feed(chunk)
+        image_bytes = upload.getbuffer()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    msg_data["is_audio"] = str(msg_data.get("is_audio", "")).lower() in ("1", "true")
+    msg_data["image_bytes"] = image_bytes
+    manager.start_turn(connection.websocket, handle_image_message, msg_data)
+    return {"status": "success", "message": "图片已接收", "size": upload.size, "format": upload.format}
+
+
+# HTTP对话接口：批量请求的并发上限和条数上限，以及请求中携带的历史消息条数上限
+TURN_BATCH_CONCURRENCY = int(os.getenv("TURN_BATCH_CONCURRENCY", "4"))
+TURN_BATCH_MAX = int(os.getenv("TURN_BATCH_MAX", "100"))
+TURN_MAX_HISTORY = int(os.getenv("TURN_MAX_HISTORY", "40"))
+# HTTP对话请求体的大小上限（JSON中的base64图片/音频，或multipart上传的文件）
+TURN_MAX_BODY_BYTES = int(float(os.getenv("TURN_MAX_BODY_MB", "16")) * 1024 * 1024)
+
+HISTORY_ROLES = {"user": ROLE_USER, "assistant": ROLE_ASSISTANT}
+
+# 受信任的反向代理地址（IP或网段，逗号分隔），只有来自这些地址的请求才采用其设置的X-Real-IP
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in os.getenv("TRUSTED_PROXIES", "").split(",") if item.strip()
+]
+
+
+def history_from_request(items) -> ChatHistory:
+    """将请求中的历史消息 [{"role": "user/assistant", "content": "..."}] 转换为ChatHistory，只保留最近的消息"""
+    history = ChatHistory()
+    if not isinstance(items, list):
+        return history
+    for item in items[-TURN_MAX_HISTORY:]:
+        if isinstance(item, dict) and item.get("role") in HISTORY_ROLES and isinstance(item.get("content"), str):
+            history.append(HISTORY_ROLES[item["role"]], item["content"])
+    return history
+
+
+async def parse_turn_request(request: Request) -> dict:
+    """
+    解析HTTP对话请求
+
+    支持 application/json（text/image/audio三种类型，image和audio为base64字符串），
+    或 multipart/form-data（image或audio文件字段，其余参数为普通字段，history为JSON字符串）
+    """
+    request = limit_request_body(request, TURN_MAX_BODY_BYTES)
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("multipart/form-data"):
+        try:
+            msg_data = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="请求体不是有效的JSON")
+        if not isinstance(msg_data, dict):
+            raise HTTPException(status_code=400, detail="请求体必须是JSON对象")
+        msg_data.setdefault("type", "audio" if "audio" in msg_data else "image" if "image" in msg_data else "text")
+        if msg_data["type"] == "audio":
+            audio_base64 = msg_data.pop("audio", "")
+            if not isinstance(audio_base64, str):
+                raise HTTPException(status_code=400, detail="audio必须是base64字符串")
+            if len(audio_base64) * 3 // 4 > audio_processor.max_utterance_bytes:
+                raise HTTPException(status_code=400, detail=f"音频大小超过限制 {audio_processor.max_utterance_bytes} 字节")
+            try:
+                msg_data["audio_bytes"] = base64.b64decode(audio_base64)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"音频解码失败: {str(e)}")
+        return msg_data
+
+    form = await request.form(max_files=1, max_fields=16)
+    try:
+        msg_data = {key: value for key, value in form.items() if isinstance(value, str)}
+        try:
+            msg_data["history"] = json.loads(msg_data.get("history", "[]"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="history不是有效的JSON")
+        msg_data["is_audio"] = str(msg_data.get("is_audio", "")).lower() in ("1", "true")
+        image_file = form.get("image")
+        audio_file = form.get("audio")
+        try:
+            if image_file is not None and not isinstance(image_file, str):
+                msg_data["type"] = "image"
+                msg_data["image_bytes"] = (await read_image_file(image_file)).getbuffer()
+            elif audio_file is not None and not isinstance(audio_file, str):
+                if audio_file.size and audio_file.size > audio_processor.max_utterance_bytes:
+                    raise ValueError(f"音频大小超过限制 {audio_processor.max_utterance_bytes} 字节")
+                msg_data["type"] = "audio"
+                msg_data["audio_bytes"] = await audio_file.read(audio_processor.max_utterance_bytes + 1)
+                if len(msg_data["audio_bytes"]) > audio_processor.max_utterance_bytes:
+                    raise ValueError(f"音频大小超过限制 {audio_processor.max_utterance_bytes} 字节")
+            else:
+                msg_data["type"] = "text"
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await form.close()
+    return msg_data
+
+
+async def run_http_turn(client_id: str, msg_data: dict, emit=None) -> dict:
+    """
+    执行一轮无状态对话，复用WebSocket接口的对话流程
+
+    历史消息由请求携带，不写入服务端的连接历史；提供emit回调时流式生成回复并逐项推送结果
+    """
+    async def notify(event: str, data: dict):
+        if emit is not None:
+            await emit(event, data)
+
+    current_client.set(client_id)
+    history = history_from_request(msg_data.get("history"))
+    msg_data.setdefault("model", "Hiyori")
+    # HTTP接口没有WebSocket连接，二进制帧推送改为返回音频URL
+    if msg_data.get("audio_delivery") == "ws":
+        msg_data["audio_delivery"] = "url"
+    turn_type = msg_data.get("type", "text")
+
+    if turn_type == "audio":
+        usage_tracker.check()
+        transcription = await track_upstream(audio_processor.transcribe_bytes(
+            f"{client_id}_{uuid.uuid4().hex[:8]}",
+            msg_data.pop("audio_bytes", b""),
+            int(msg_data.get("sample_rate", 16000)),
+            int(msg_data.get("channels", 1)),
+        ))
+        await notify("transcription", {"text": transcription})
+        if not transcription:
+            raise ValueError("语音识别结果为空")
+        msg_data["content"] = transcription
+        turn_type = "text"
+
+    if turn_type == "image":
+        usage_tracker.check()
+        result = await track_upstream(image_processor.process_image_message(msg_data))
+        if result["status"] != "success":
+            raise ValueError(result.get("message", "图片处理失败"))
+        reply = {"reply": result["description"], "animation_index": 0, "should_take_photo": False}
+        await notify("reply", {"text": reply["reply"]})
+    elif turn_type == "text":
+        if not msg_data.get("content"):
+            raise ValueError("文本内容为空")
+        reply = await generate_text_reply(history, msg_data, emit)
+    else:
+        raise ValueError(f"未知的对话类型: {turn_type}")
+
+    audio_url, lipsync, _, _ = await prepare_turn_audio(reply["reply"], msg_data)
+    reply["audio_url"] = audio_url
+    if audio_url:
+        await notify("audio", {"audio_url": audio_url, "lipsync": lipsync})
+    return reply
+
+
+def client_address(request: Request) -> str:
+    """请求的来源地址；对端是受信任的反向代理时采用代理设置的X-Real-IP"""
+    host = request.client.host if request.client else ""
+    real_ip = request.headers.get("x-real-ip", "").strip()
+    if real_ip and host and TRUSTED_PROXIES:
+        try:
+            peer = ipaddress.ip_address(host)
+        except ValueError:
+            peer = None
+        if peer is not None and any(peer in network for network in TRUSTED_PROXIES):
+            return real_ip[:64]
+    return host or "unknown"
+
+
+def request_client_id(request: Request, body: dict) -> str:
+    """
+    HTTP请求的客户端标识，用于用量统计和额度控制
+
+    优先使用X-Client-Id请求头或client_id字段，未提供时按来源地址记为 http_<IP>；
+    启用额度控制时只认可 USAGE_CLIENT_BUDGETS 中配置的标识，其余请求按来源地址统计，避免更换标识重置额度
+    """
+    client_id = request.headers.get("x-client-id") or body.get("client_id")
+    client_id = str(client_id)[:64] if client_id else None
+    if client_id and (not usage_tracker.budgets_enabled or client_id in usage_tracker.budgets):
+        return client_id
+    return f"http_{client_address(request)}"
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/v1/turn")
+async def http_turn(request: Request):
+    """
+    无状态HTTP对话接口，以Server-Sent Events返回结果
+
+    事件依次为: transcription（仅音频）、delta（回复片段）、reply（完整回复）、animation（动画索引）、
+    photo（是否需要拍照）、audio（音频URL，仅开启语音时）、done，出错时为error
+    """
+    msg_data = await parse_turn_request(request)
+    client_id = request_client_id(request, msg_data)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def emit(event: str, data: dict):
+        await queue.put(format_sse(event, data))
+
+    async def run():
+        load_shedder.turn_started()
+        try:
+            reply = await run_http_turn(client_id, msg_data, emit)
+            await emit("done", {"status": "success", "audio_url": reply["audio_url"]})
+        except Exception as e:
+            print(f"[http_turn] 对话处理失败: {str(e)}")
+            await emit("error", {"status": "error", "message": str(e)})
+        finally:
+            load_shedder.turn_finished()
+            await queue.put(None)
+
+    async def events():
+        task = asyncio.create_task(run())
+        try:
+            while (item := await queue.get()) is not None:
+                yield item
+        finally:
+            # 客户端断开时取消进行中的对话
+            task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/v1/turn/batch")
+async def http_turn_batch(request: Request):
+    """
+    批量文本对话，按并发上限同时处理多条提示，结果按提交顺序返回
+
+    请求体: {"prompts": ["...", ...] 或 [{"content": "...", "history": [...]}, ...], "concurrency": 4, "model": "Hiyori", "is_audio": false}
+    """
+    try:
+        body = await limit_request_body(request, TURN_MAX_BODY_BYTES).json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="请求体不是有效的JSON")
+    prompts = body.get("prompts") if isinstance(body, dict) else None
+    if not isinstance(prompts, list) or not prompts:
+        raise HTTPException(status_code=400, detail="prompts不能为空")
+    if len(prompts) > TURN_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"单次最多 {TURN_BATCH_MAX} 条提示")
+
+    client_id = request_client_id(request, body)
+    try:
+        concurrency = int(body.get("concurrency", TURN_BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="concurrency必须是整数")
+    concurrency = min(max(concurrency, 1), TURN_BATCH_CONCURRENCY)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def score(index: int, prompt) -> dict:
+        msg_data = dict(prompt) if isinstance(prompt, dict) else {"content": prompt}
+        msg_data["type"] = "text"
+        msg_data.setdefault("model", body.get("model", "Hiyori"))
+        msg_data.setdefault("is_audio", bool(body.get("is_audio", False)))
+        async with semaphore:
+            load_shedder.turn_started()
+            try:
+                reply = await run_http_turn(client_id, msg_data)
+                return {"index": index, "status": "success", **reply}
+            except Exception as e:
+                return {"index": index, "status": "error", "message": str(e)}
+            finally:
+                load_shedder.turn_finished()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(score(i, prompt) for i, prompt in enumerate(prompts)))
+    return {
+        "status": "success",
+        "concurrency": concurrency,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+        "results": results,
+    }
+
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await manager.connect(websocket)
+    connection = await manager.connect(websocket, client_id)
+    # 接收循环只负责解析消息并放入队列，消息处理和对话轮次由分发任务执行
+    manager.add_task(websocket, asyncio.create_task(dispatch_messages(websocket, client_id, connection.inbox)))
     try:
         # 发送欢迎消息
         await manager.send_personal_message("你好，我是你的好朋友，小凡...", "", websocket, msg_type=1)
 
         while True:
-            data = await websocket.receive_text()
-
-            try:
-                print(f"[websocket_endpoint] 接收到原始数据: {data}")
-                # 使用新的消息解析器
-                msg_type, msg_data, error = message_parser.parse_message(data)
-
-                if error:
-                    print(f"[websocket_endpoint] 消息解析错误: {error}")
-                    await manager.send_personal_message(f"消息格式错误: {error}", "", websocket, msg_type=1)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # 连接已被释放（发送失败、慢客户端、心跳超时或被新连接替换），停止接收
+            if connection.closed:
+                break
+            manager.touch(websocket)
+
+            # 解析之前先检查帧大小和限流
+            data = message.get("text")
+            payload = message.get("bytes") if data is None else data
+            size = len(payload or "")
+            rejection = inbound_guard.check_frame(connection.limits, size)
+            if rejection == "oversized":
+                print(f"[websocket_endpoint] 客户端 {client_id} 发送的帧过大（{size}），断开连接")
+                await websocket.close(code=1009)
+                break
+
+            # 二进制帧为已声明的图片上传数据
+            if data is None:
+                rejection = rejection or inbound_guard.check_type(connection.limits, "binary", size)
+                if rejection:
+                    if not await abort_chunked_upload(websocket, connection, rejection, "image"):
+                        await notify_rejection(websocket, connection, rejection, "image")
+                    continue
+                await receive_image_chunk(websocket, connection, payload or b"")
+                continue
+
+            sniffed_type = inbound_guard.sniff_type(data)
+            if rejection is None:
+                if sniffed_type:
+                    rejection = inbound_guard.check_type(connection.limits, sniffed_type, size)
+                else:
+                    # 无法在解析前确定类型时按较小的上限检查，避免大帧被完整解析
+                    rejection = inbound_guard.check_unknown(size)
+            if rejection:
+                await reject_message(websocket, connection, rejection, sniffed_type or "unknown")
+                continue
+
+            print(f"[websocket_endpoint] 接收到原始数据: {data[:200]}")
+            # 使用新的消息解析器
+            msg_type, msg_data, error = message_parser.parse_message(data)
+
+            if error:
+                print(f"[websocket_endpoint] 消息解析错误: {error}")
+                await manager.send_personal_message(f"消息格式错误: {error}", "", websocket, msg_type=1)
+                continue
+
+            # type不在开头的消息，解析后再按实际类型检查
+            if sniffed_type is None:
+                rejection = inbound_guard.check_type(connection.limits, msg_type or "unknown", size)
+                if rejection:
+                    await reject_message(websocket, connection, rejection, msg_type or "unknown")
                     continue
 
-                print(f"[websocket_endpoint] 接收到消息类型: {msg_type}")
+            print(f"[websocket_endpoint] 接收到消息类型: {msg_type}")
+            if msg_type != "image":
                 print(f"[websocket_endpoint] 消息数据: {msg_data}")
 
-                # 处理不同类型的消息
-                if msg_type == "control":
-                    await handle_control_message(websocket, client_id, msg_data)
-                    continue
-                elif msg_type == "audio":
-                    await handle_audio_message(websocket, client_id, msg_data)
-                    continue
-                elif msg_type == "text":
-                    await handle_text_message(websocket, client_id, msg_data)
-                    continue
-                elif msg_type == "image":
-                    await handle_image_message(websocket, client_id, msg_data)
-                    continue
-
-            except json.JSONDecodeError:
-                await manager.send_personal_message("消息格式错误，请发送 JSON 格式的消息", "", websocket, msg_type=1)
-            except Exception as e:
-                await manager.send_personal_message(f"AI 错误: {str(e)}", "", websocket, msg_type=1)
+            if msg_type == "pong":
+                continue
+            # 只声明大小、不带图片内容的图片消息，图片随后以二进制帧发送
+            if msg_type == "image" and "image" not in msg_data and "size" in msg_data:
+                await start_image_upload(websocket, connection, msg_data)
+                continue
+            if connection.closed:
+                break
+            await connection.inbox.put((msg_type, msg_data))
 
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
         await manager.broadcast(f"Client {client_id} left the chat")
 
+
+# 入站消息被拒绝时返回给客户端的提示
+LIMIT_MESSAGES = {
+    "rate_limited": "消息发送过于频繁，已丢弃",
+    "frame_too_large": "消息过大，已丢弃",
+}
+
+
+async def notify_rejection(websocket: WebSocket, connection: Connection, reason: str, msg_type: str):
+    """通知客户端消息被拒绝，同一连接的提示频率受限"""
+    if not inbound_guard.should_notify(connection.limits):
+        return
+    print(f"[websocket_endpoint] 客户端 {connection.client_id} 的 {msg_type} 消息被拒绝: {reason}")
+    response = {
+        "type": "response",
+        "data": {
+            "status": "error",
+            "message": LIMIT_MESSAGES.get(reason, reason),
+            "request_type": msg_type,
+            "code": reason
+        }
+    }
+    await manager.send_json(response, websocket)
+
+
+async def reject_message(websocket: WebSocket, connection: Connection, reason: str, msg_type: str):
+    """丢弃被拒绝的消息：音频块被丢弃时中止录音，其余消息只提示"""
+    if msg_type == "audio" and await abort_chunked_upload(websocket, connection, reason, msg_type):
+        return
+    await notify_rejection(websocket, connection, reason, msg_type)
+
+
+async def abort_chunked_upload(websocket: WebSocket, connection: Connection, reason: str, msg_type: str) -> bool:
+    """
+    分块上传的数据被丢弃时中止整个上传（图片上传或录音），并通知客户端（不受提示频率限制）
+
+    Returns:
+        是否有被中止的上传
+    """
+    if msg_type == "image" and connection.upload is not None:
+        connection.upload = None
+        print(f"[websocket_endpoint] 客户端 {connection.client_id} 的图片数据被丢弃，上传已中止")
+        action = "图片上传已中止"
+    elif msg_type == "audio" and audio_processor.abort_audio_stream(connection.client_id):
+        action = "录音已中止"
+    else:
+        return False
+    response = {
+        "type": "response",
+        "data": {
+            "status": "error",
+            "message": f"{LIMIT_MESSAGES.get(reason, reason)}，{action}",
+            "request_type": msg_type,
+            "code": reason,
+            "aborted": True
+        }
+    }
+    await manager.send_json(response, websocket)
+    return True
+
+
+async def send_image_error(websocket: WebSocket, message: str):
+    response = {
+        "type": "response",
+        "data": {
+            "status": "error",
+            "message": message,
+            "request_type": "image"
+        }
+    }
+    print(f"[websocket_endpoint] 图片上传失败: {message}")
+    await manager.send_json(response, websocket)
+
+
+async def start_image_upload(websocket: WebSocket, connection: Connection, msg_data: dict):
+    """按声明的大小预分配缓冲区，超过上限直接拒绝"""
+    try:
+        connection.upload = (image_processor.create_upload(int(msg_data["size"])), msg_data)
+    except (TypeError, ValueError) as e:
+        connection.upload = None
+        await send_image_error(websocket, str(e))
+
+
+async def receive_image_chunk(websocket: WebSocket, connection: Connection, chunk: bytes):
+    """将二进制帧写入上传缓冲区，接收完整后作为图片消息进入分发队列"""
+    if connection.upload is None:
+        await send_image_error(websocket, "未声明图片上传，已忽略二进制数据")
+        return
+    upload, msg_data = connection.upload
+    try:
+        upload.feed(chunk)
+        if not upload.complete:
+            return
+        msg_data = dict(msg_data, image_bytes=upload.getbuffer())
+    except ValueError as e:
+        connection.upload = None
+        await send_image_error(websocket, str(e))
+        return
+    connection.upload = None
+    await connection.inbox.put(("image", msg_data))
+
+
+async def dispatch_messages(websocket: WebSocket, client_id: str, inbox: asyncio.Queue):
+    """消息分发任务：音频块和控制消息就地处理，文本、图片和语音识别后的对话以独立任务运行"""
+    while True:
+        msg_type, msg_data = await inbox.get()
+        try:
+            # 处理不同类型的消息
+            if msg_type == "control":
+                await handle_control_message(websocket, client_id, msg_data)
+            elif msg_type == "audio":
+                await handle_audio_message(websocket, client_id, msg_data)
+            elif msg_type == "text":
+                # 新的用户消息会打断进行中的对话
+                manager.start_turn(websocket, handle_text_message, msg_data)
+            elif msg_type == "image":
+                manager.start_turn(websocket, handle_image_message, msg_data)
+        except Exception as e:
+            await manager.send_personal_message(f"AI 错误: {str(e)}", "", websocket, msg_type=1)
+
 # 新增的处理函数
 async def handle_control_message(websocket: WebSocket, client_id: str, msg_data: dict):
     """处理控制消息"""
@@ -165,6 +1435,9 @@ async def handle_control_message(websocket: WebSocket, client_id: str, msg_data:
     print(f"[handle_control_message] 接收到控制消息，客户端: {client_id}, 动作: {action}")
 
     if action == "start_audio_stream":
+        # 用户开始说话，打断进行中的回复和TTS
+        if manager.cancel_turn(websocket):
+            print(f"[handle_control_message] 客户端 {client_id} 开始说话，已打断当前回复")
         audio_processor.start_audio_stream(client_id)
         response = {
             "type": "response",
@@ -175,36 +1448,10 @@ async def handle_control_message(websocket: WebSocket, client_id: str, msg_data:
             }
         }
         print(f"[handle_control_message] 发送响应: {response}")
-        await websocket.send_text(json.dumps(response))
+        await manager.send_json(response, websocket)
 
     elif action == "stop_audio_stream":
-        # 先处理完整音频，获取识别结果
-        transcription = await audio_processor._process_complete_audio(client_id)
-        await websocket.send_text(transcription)
-
-        audio_processor.stop_audio_stream(client_id)
-
-        # 如果有识别结果，将其传递给AI对话系统
-        if transcription:
-            # 构造文本消息并处理
-            text_msg_data = {
-                "content": transcription,
-                "model": "Hiyori",
-                "is_audio": True
-            }
-            await handle_text_message(websocket, client_id, text_msg_data)
-
-        response = {
-            "type": "response",
-            "data": {
-                "status": "success",
-                "message": f"音频流已停止，识别结果: {transcription}",
-                "request_type": "control",
-                "transcription": transcription
-            }
-        }
-        print(f"[handle_control_message] 发送响应: {response}")
-        await websocket.send_text(json.dumps(response))
+        manager.start_turn(websocket, handle_voice_turn, msg_data)
 
     else:
         response = {
@@ -216,7 +1463,40 @@ async def handle_control_message(websocket: WebSocket, client_id: str, msg_data:
             }
         }
         print(f"[handle_control_message] 发送错误响应: {response}")
-        await websocket.send_text(json.dumps(response))
+        await manager.send_json(response, websocket)
+
+async def handle_voice_turn(websocket: WebSocket, client_id: str, msg_data: dict):
+    """处理一段完整语音：识别后作为文本消息进入对话"""
+    # 先处理完整音频，获取识别结果
+    transcription = await track_upstream(audio_processor._process_complete_audio(client_id))
+    if transcription:
+        await manager.send_text(transcription, websocket)
+
+    audio_processor.stop_audio_stream(client_id)
+
+    # 如果有识别结果，将其传递给AI对话系统
+    if transcription:
+        # 构造文本消息并处理
+        text_msg_data = {
+            "content": transcription,
+            "model": "Hiyori",
+            "is_audio": True
+        }
+        if "audio_delivery" in msg_data:
+            text_msg_data["audio_delivery"] = msg_data["audio_delivery"]
+        await handle_text_message(websocket, client_id, text_msg_data)
+
+    response = {
+        "type": "response",
+        "data": {
+            "status": "success",
+            "message": f"音频流已停止，识别结果: {transcription}",
+            "request_type": "control",
+            "transcription": transcription
+        }
+    }
+    print(f"[handle_voice_turn] 发送响应: {response}")
+    await manager.send_json(response, websocket)
 
 async def handle_audio_message(websocket: WebSocket, client_id: str, msg_data: dict):
     """处理音频消息"""
@@ -235,16 +1515,22 @@ async def handle_audio_message(websocket: WebSocket, client_id: str, msg_data: d
         }
     }
     print(f"[handle_audio_message] 发送响应: {response}")
+    # 成功接收的音频块不逐块回复，只通知错误（如录音超长）
+    if result["status"] == "error":
+        await manager.send_json(response, websocket)
 
 async def handle_image_message(websocket: WebSocket, client_id: str, msg_data: dict):
     """处理图片消息"""
     print(f"[handle_image_message] 接收到图片消息，客户端: {client_id}")
-    print(f"[handle_image_message] 消息数据长度: {len(msg_data.get('image', '')) if 'image' in msg_data else 0} 字符")
-    is_audio = msg_data.get("is_audio", False)
-    print(f"[handle_image_message] 是否音频消息: {is_audio}")
+    if "image_bytes" in msg_data:
+        print(f"[handle_image_message] 二进制图片大小: {len(msg_data['image_bytes'])} 字节")
+    else:
+        print(f"[handle_image_message] 消息数据长度: {len(msg_data.get('image', ''))} 字符")
+    print(f"[handle_image_message] 是否音频消息: {msg_data.get('is_audio', False)}")
 
-    # 处理图片消息
-    result = await image_processor.process_image_message(msg_data)
+    # 处理图片消息（用量超过额度时抛出BudgetExceeded，由对话轮次统一返回错误）
+    usage_tracker.check()
+    result = await track_upstream(image_processor.process_image_message(msg_data))
 
     # 同时发送AI对图片的描述作为聊天消息
     if result["status"] == "success" and "description" in result:
@@ -253,14 +1539,11 @@ async def handle_image_message(websocket: WebSocket, client_id: str, msg_data: d
 
         humanMessage = msg_data.get("prompt", None) if msg_data.get("prompt", None) else "拍照"
         # 将用户消息和AI回复添加到历史记录
-        manager.add_message_to_history(client_id, HumanMessage(content=humanMessage))
-        manager.add_message_to_history(client_id, AIMessage(content=ai_response))
+        manager.add_message_to_history(client_id, ROLE_USER, humanMessage)
+        manager.add_message_to_history(client_id, ROLE_ASSISTANT, ai_response)
 
         # TTS处理
-        audio_url = ""
-        if os.getenv("ISAUDIO", False) != False and is_audio:
-          clean_text = remove_emojis(ai_response)
-          audio_url = await http_service.generate_tts_audio(clean_text)
+        audio_url, lipsync, audio_stream, clean_text = await prepare_turn_audio(ai_response, msg_data)
 
         # 发送 AI 回复
         await manager.send_personal_message(
@@ -270,15 +1553,19 @@ async def handle_image_message(websocket: WebSocket, client_id: str, msg_data: d
           msg_type=1,
           animation_index=0,
           should_take_photo=False,
-          prompt=None
+          prompt=None,
+          lipsync=lipsync,
+          audio_stream=audio_stream
         )
 
+        if audio_stream:
+          await track_upstream(stream_reply_audio(websocket, audio_stream, clean_text), sample_latency=False)
+    else:
+        await send_image_error(websocket, result.get("message", "图片处理失败"))
+
 async def handle_text_message(websocket: WebSocket, client_id: str, msg_data: dict):
     """处理文本消息 - 重用原有的AI对话逻辑"""
     text = msg_data.get("content", "")
-    model = msg_data.get("model", "Hiyori")
-    is_audio = msg_data.get("is_audio", False)
-    has_image = msg_data.get("has_image", False)
 
     if not text:
         response = {
@@ -289,54 +1576,22 @@ async def handle_text_message(websocket: WebSocket, client_id: str, msg_data: di
                 "request_type": "text"
             }
         }
-        await websocket.send_text(json.dumps(response))
+        await manager.send_json(response, websocket)
         return
 
     # 重用原有的AI对话处理逻辑
     try:
-        # 使用大模型服务调用AI
-        system_prompt = """你叫小凡，是一个知心朋友，可爱的小女生，要有同理心。
-            你的性格特点：
-            - 温柔体贴，善于倾听
-            - 说话亲切自然，像好朋友一样聊天
-            - 能够理解对方的情绪，给予安慰和支持
-            - 回复时使用轻松活泼的语气，适当使用表情符号
-            - 避免过于正式或机械的表达
-
-           请记住，你是一个可爱的小女生，你的主要任务是与用户进行轻松、自然的对话。
-           不要使用任何专业术语或复杂的表达，尽量使用简单、通俗易懂的语言。
-           请尽量使用表情符号来增加对话的趣味性。请始终保持这个角色设定，用温暖、真诚的态度与用户交流。
-
-           """
-
-        # 获取历史消息
+        # 获取历史消息，由大模型服务拼接当前用户消息并按需转换格式
         message_history = manager.get_message_history(client_id)
-
-        # 构建消息列表：历史消息 + 当前用户消息
-        messages: List[BaseMessage] = message_history + [HumanMessage(content=text)]
-
-        # 调用大模型服务获取回复
-        ai_response = await llm_service.chat(messages, system_prompt)
-
-        # messages.append(AIMessage(content=ai_response))
-        # 调用大模型服务获取动画索引
-        animation_index = await llm_service.get_animation_index(messages, model)
-
-        should_take_photo = False
-        if not has_image:
-          # 调用大模型服务判断是否需要拍照
-          should_take_photo = await llm_service.should_take_photo(messages)
-          print(f"[handle_text_message] 是否需要拍照: {should_take_photo}")
+        reply = await generate_text_reply(message_history, msg_data)
+        ai_response = reply["reply"]
 
         # 将用户消息和AI回复添加到历史记录
-        manager.add_message_to_history(client_id, HumanMessage(content=text))
-        manager.add_message_to_history(client_id, AIMessage(content=ai_response))
+        manager.add_message_to_history(client_id, ROLE_USER, text)
+        manager.add_message_to_history(client_id, ROLE_ASSISTANT, ai_response)
 
         # TTS处理
-        audio_url = ""
-        if os.getenv("ISAUDIO", False) != False and is_audio:
-            clean_text = remove_emojis(ai_response)
-            audio_url = await http_service.generate_tts_audio(clean_text)
+        audio_url, lipsync, audio_stream, clean_text = await prepare_turn_audio(ai_response, msg_data)
 
         # 发送 AI 回复
         await manager.send_personal_message(
@@ -344,11 +1599,16 @@ async def handle_text_message(websocket: WebSocket, client_id: str, msg_data: di
             audio_url,
             websocket,
             msg_type=1,
-            animation_index=int(animation_index),
-            should_take_photo=should_take_photo,
-            prompt=text
+            animation_index=reply["animation_index"],
+            should_take_photo=reply["should_take_photo"],
+            prompt=text,
+            lipsync=lipsync,
+            audio_stream=audio_stream
         )
 
+        if audio_stream:
+            await track_upstream(stream_reply_audio(websocket, audio_stream, clean_text), sample_latency=False)
+
         # # 发送确认响应
         # response_msg = {
         #     "type": "response",
@@ -369,7 +1629,7 @@ async def handle_text_message(websocket: WebSocket, client_id: str, msg_data: di
                 "request_type": "text"
             }
         }
-        await websocket.send_text(json.dumps(response_msg))
+        await manager.send_json(response_msg, websocket)
 
 if __name__ == "__main__":
     uvicorn.run(
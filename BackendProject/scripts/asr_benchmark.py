@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+语音识别后端基准测试
+对比各后端在样例音频上的识别延迟和实时率（RTF = 识别耗时 / 音频时长）
+
+用法:
+    python scripts/asr_benchmark.py --backends siliconflow local --repeat 3 [音频文件 ...]
+未指定音频文件时使用 FrontendProject/Resources 下的模型语音
+"""
+import argparse
+import asyncio
+import glob
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers.audio_normalizer import audio_normalizer  # noqa: E402
+from services.asr_service import ASR_BACKENDS, create_backends  # noqa: E402
+
+DEFAULT_CLIPS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "FrontendProject", "Resources", "*", "sounds", "*.wav"
+)
+
+
+def prepare_clip(path: str, workdir: str):
+    """按线上流程规整音频，返回 (规整后文件路径, MIME类型, 时长秒)"""
+    with open(path, "rb") as f:
+        normalized = audio_normalizer.normalize(f.read())
+    duration = normalized["duration"] or 0.0
+    target = os.path.join(workdir, f"{os.path.splitext(os.path.basename(path))[0]}.{normalized['extension']}")
+    with open(target, "wb") as f:
+        f.write(normalized["data"])
+    return target, normalized["mime"], duration
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+async def run(args):
+    clips = args.clips or sorted(glob.glob(DEFAULT_CLIPS))
+    if not clips:
+        print("未找到样例音频")
+        return
+
+    backends = create_backends(args.backends)
+    with tempfile.TemporaryDirectory() as workdir:
+        prepared = [prepare_clip(path, workdir) for path in clips]
+
+        for name, backend in backends.items():
+            start = time.perf_counter()
+            await backend.start()
+            print(f"\n== {name}（启动耗时 {(time.perf_counter() - start) * 1000:.0f} ms）==")
+
+            latencies, rtfs = [], []
+            for filepath, mime, duration in prepared:
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    text = await backend.transcribe(filepath, mime)
+                    elapsed = time.perf_counter() - start
+                    latencies.append(elapsed * 1000)
+                    if duration:
+                        rtfs.append(elapsed / duration)
+                print(f"{os.path.basename(filepath):<28} {duration:6.2f}s  {elapsed * 1000:8.1f} ms  {text!r}")
+
+            await backend.close()
+            print(
+                f"延迟 p50 {percentile(latencies, 0.5):.1f} ms, p95 {percentile(latencies, 0.95):.1f} ms; "
+                f"RTF 平均 {sum(rtfs) / max(len(rtfs), 1):.3f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="语音识别后端基准测试")
+    parser.add_argument("clips", nargs="*", help="音频文件路径")
+    parser.add_argument("--backends", nargs="+", default=list(ASR_BACKENDS), choices=list(ASR_BACKENDS))
+    parser.add_argument("--repeat", type=int, default=3, help="每个音频重复识别次数")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+连接注册表压力测试
+反复建立/断开连接（附带历史记录、音频缓冲和挂起任务），检查释放后内存保持平稳
+
+用法:
+    python scripts/connection_soak.py --iterations 1000000 --checkpoints 10
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers.audio_handler import audio_processor  # noqa: E402
+from main import ConnectionManager  # noqa: E402
+from services.history_service import ROLE_ASSISTANT, ROLE_USER  # noqa: E402
+
+
+class FakeWebSocket:
+    """只实现ConnectionManager用到的接口"""
+
+    def __init__(self):
+        self.state = SimpleNamespace()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def current_rss_mb() -> float:
+    """读取当前进程常驻内存（Linux）"""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+async def run(args):
+    manager = ConnectionManager()
+    chunk = {"chunk": "AAAA" * 256, "sample_rate": 16000, "channels": 1}
+    step = max(args.iterations // args.checkpoints, 1)
+    samples = []
+    start = time.perf_counter()
+    # 压测时屏蔽服务端的逐条日志
+    quiet = open(os.devnull, "w")
+
+    for i in range(1, args.iterations + 1):
+        client_id = f"soak-{i % args.clients}"
+        with contextlib.redirect_stdout(quiet):
+            websocket = FakeWebSocket()
+            await manager.connect(websocket, client_id)
+            await manager.send_personal_message("hello", "", websocket)
+            manager.add_message_to_history(client_id, ROLE_USER, "你好")
+            manager.add_message_to_history(client_id, ROLE_ASSISTANT, "你好呀")
+            audio_processor.start_audio_stream(client_id)
+            await audio_processor.process_audio_chunk(client_id, chunk)
+            manager.add_task(websocket, asyncio.create_task(asyncio.sleep(3600)))
+            manager.disconnect(websocket)
+        # 让被取消的任务完成
+        await asyncio.sleep(0)
+
+        if i % step == 0:
+            gc.collect()
+            await asyncio.sleep(0)
+            rss = current_rss_mb()
+            samples.append(rss)
+            print(
+                f"{i:>9} 次  RSS {rss:7.1f} MB  连接 {len(manager.active_connections)}  "
+                f"历史 {len(manager.message_history)}  音频缓冲 {len(audio_processor.audio_buffers)}  "
+                f"任务 {len(asyncio.all_tasks())}  {time.perf_counter() - start:6.1f}s"
+            )
+
+    # 以第一个检查点为基线（包含解释器和缓存的预热开销）
+    growth = samples[-1] - samples[0] if samples else 0.0
+    print(f"内存增长: {growth:.1f} MB（阈值 {args.max_growth_mb} MB）")
+    return growth <= args.max_growth_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description="连接注册表压力测试")
+    parser.add_argument("--iterations", type=int, default=1_000_000)
+    parser.add_argument("--clients", type=int, default=1000, help="循环使用的client_id数量")
+    parser.add_argument("--checkpoints", type=int, default=10)
+    parser.add_argument("--max-growth-mb", type=float, default=16.0)
+    ok = asyncio.run(run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+对话历史存储基准测试
+对比LangChain消息对象列表与ChatHistory的每客户端内存占用，以及每轮组装消息的耗时
+
+用法:
+    python scripts/history_benchmark.py --clients 200 --turns 50 --providers openai zhipu
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage  # noqa: E402
+
+from services.history_service import ChatHistory, ROLE_ASSISTANT, ROLE_USER, convert_message  # noqa: E402
+
+SYSTEM_PROMPT = "你叫小凡，是一个知心朋友，可爱的小女生，要有同理心。"
+
+
+def legacy_messages(provider, history, text):
+    """旧实现：每轮重新拼接LangChain消息，智谱AI再逐条转换为字典"""
+    messages = [SystemMessage(content=SYSTEM_PROMPT)] + history + [HumanMessage(content=text)]
+    if provider == "zhipu":
+        return [{"role": "user", "content": msg.content} for msg in messages]
+    return messages
+
+
+def compact_messages(provider, history, system_message, text):
+    """新实现：智谱AI复用已转换的前缀，OpenAI每轮从紧凑存储构造消息对象"""
+    return [system_message] + history.convert(provider) + [convert_message(provider, ROLE_USER, text)]
+
+
+def measure_memory(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    histories = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del histories
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对话历史存储基准测试")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=50, help="每个客户端的对话轮数")
+    parser.add_argument("--providers", nargs="+", default=["openai", "zhipu"], choices=["openai", "zhipu"])
+    args = parser.parse_args()
+
+    user_text = "今天天气怎么样，适合出去走走吗？"
+    ai_text = "今天阳光很好哦，很适合出去散步呢 😊"
+
+    def build_legacy():
+        return [
+            [msg for _ in range(args.turns) for msg in (HumanMessage(content=user_text), AIMessage(content=ai_text))]
+            for _ in range(args.clients)
+        ]
+
+    def build_compact(provider):
+        histories = []
+        for _ in range(args.clients):
+            history = ChatHistory()
+            for _ in range(args.turns):
+                history.append(ROLE_USER, user_text)
+                history.append(ROLE_ASSISTANT, ai_text)
+            # 包含已转换前缀缓存的占用（只有缓存的提供商会保留）
+            history.convert(provider)
+            histories.append(history)
+        return histories
+
+    legacy_bytes = measure_memory(build_legacy) / args.clients
+    for provider in args.providers:
+        compact_bytes = measure_memory(lambda: build_compact(provider)) / args.clients
+        print(f"[{provider}] 每客户端内存（{args.turns} 轮）: LangChain {legacy_bytes / 1024:.1f} KB，"
+              f"ChatHistory {compact_bytes / 1024:.1f} KB（{compact_bytes / legacy_bytes:.1%}）")
+
+        # 模拟一个客户端连续对话，统计每轮组装消息的耗时
+        legacy_history = []
+        compact_history = ChatHistory()
+        system_message = convert_message(provider, 0, SYSTEM_PROMPT)
+        legacy_time = compact_time = 0.0
+        for _ in range(args.turns):
+            start = time.perf_counter()
+            legacy_messages(provider, legacy_history, user_text)
+            legacy_time += time.perf_counter() - start
+            legacy_history += [HumanMessage(content=user_text), AIMessage(content=ai_text)]
+
+            start = time.perf_counter()
+            compact_messages(provider, compact_history, system_message, user_text)
+            compact_time += time.perf_counter() - start
+            compact_history.append(ROLE_USER, user_text)
+            compact_history.append(ROLE_ASSISTANT, ai_text)
+
+        print(f"[{provider}] 每轮组装消息平均耗时: LangChain {legacy_time / args.turns * 1e6:.1f} us，"
+              f"ChatHistory {compact_time / args.turns * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+Live2D模型资源构建工具
+读取 Resources 下每个 *.model3.json 及其引用的文件，输出可长期缓存的精简资源：
+
+- JSON文件（模型、动作、表情、物理、姿势等）去除缩进和空白
+- 引用的文件按内容哈希重命名（如 motions/idle.motion3.1a2b3c4d5e.json），
+  model3.json 中的引用同步改写，入口 model3.json 保持原名
+- 可压缩的文件预先生成 .gz 和 .br（需安装brotli）
+- 可选将 motion3.json 的曲线数据量化并差分编码为二进制（--binary），格式见 MOTION_BINARY_SPEC
+- 输出 manifest.json（原路径 -> 输出路径、sha256、各编码大小），并打印每个模型的体积变化
+
+用法:
+    python scripts/motion_assets.py --out build/Resources [--binary]
+    python scripts/motion_assets.py --out build/Resources --serve 8080
+"""
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import struct
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:  # brotli为可选依赖，缺失时只生成gzip
+    brotli = None
+
+DEFAULT_SRC = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "FrontendProject", "Resources"
+)
+
+MOTION_BINARY_SPEC = """
+二进制动作格式（.motion3.bin，小端序）
+
+    magic       4字节  b"L2MB"
+    version     uint8  1
+    header_len  uint32 头部JSON长度
+    header      UTF-8 JSON：原motion3.json去掉各曲线的Segments后的内容，
+                另加 "Encoding": {"TimeQuantum": tq, "ValueQuantum": vq}
+    每条曲线（顺序与header.Curves一致）:
+        segment_count  varint
+        segment_types  segment_count 个uint8（0线性、1贝塞尔、2步进、3反向步进）
+        point_count    varint（= 1 + 每段的点数之和，贝塞尔3个点，其余1个点）
+        times          point_count 个 zigzag varint，量化时间 round(t / tq) 的逐点差分
+        values         point_count 个 zigzag varint，量化数值 round(v / vq) 的逐点差分
+
+还原: 对差分做累加后乘以量化步长，按 [t0, v0, type, 点..., type, 点...] 重新展开为Segments。
+"""
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hashed_name(path: str, digest: str) -> str:
+    """在扩展名前插入内容哈希，如 a/b.motion3.json -> a/b.motion3.1a2b3c4d5e.json"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.{digest[:10]}{ext}"
+
+
+def minify_json(data: bytes) -> bytes:
+    return json.dumps(
+        json.loads(data.decode("utf-8-sig")), ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def _write_varints(out: bytearray, values: np.ndarray):
+    for value in values.tolist():
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def _read_varints(data: bytes, offset: int, count: int) -> Tuple[List[int], int]:
+    values = []
+    for _ in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values, offset
+
+
+def _zigzag_deltas(quantized: np.ndarray) -> np.ndarray:
+    deltas = np.diff(quantized, prepend=0).astype(np.int64)
+    return ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+
+
+def _unzigzag_cumsum(values: List[int]) -> np.ndarray:
+    encoded = np.array(values, dtype=np.uint64)
+    deltas = (encoded >> np.uint64(1)).astype(np.int64) ^ -(encoded & np.uint64(1)).astype(np.int64)
+    return np.cumsum(deltas)
+
+
+def split_segments(segments: List[float]) -> Tuple[List[int], List[Tuple[float, float]]]:
+    """将Segments数组拆分为段类型列表和点列表"""
+    types = []
+    points = [(segments[0], segments[1])]
+    i = 2
+    while i < len(segments):
+        segment_type = int(segments[i])
+        types.append(segment_type)
+        i += 1
+        for _ in range(3 if segment_type == 1 else 1):
+            points.append((segments[i], segments[i + 1]))
+            i += 2
+    return types, points
+
+
+def join_segments(types: List[int], points: List[Tuple[float, float]]) -> List[float]:
+    segments = [points[0][0], points[0][1]]
+    index = 1
+    for segment_type in types:
+        segments.append(segment_type)
+        for _ in range(3 if segment_type == 1 else 1):
+            segments.extend(points[index])
+            index += 1
+    return segments
+
+
+def encode_motion(motion: Dict, time_quantum: float, value_quantum: float) -> bytes:
+    """按 MOTION_BINARY_SPEC 编码动作数据"""
+    header = dict(motion)
+    header["Curves"] = [{k: v for k, v in curve.items() if k != "Segments"} for curve in motion["Curves"]]
+    header["Encoding"] = {"TimeQuantum": time_quantum, "ValueQuantum": value_quantum}
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    out = bytearray(b"L2MB")
+    out += struct.pack("<BI", 1, len(header_bytes))
+    out += header_bytes
+    for curve in motion["Curves"]:
+        types, points = split_segments(curve["Segments"])
+        coords = np.array(points, dtype=np.float64)
+        _write_varints(out, np.array([len(types)], dtype=np.uint64))
+        out += bytes(types)
+        _write_varints(out, np.array([len(points)], dtype=np.uint64))
+        _write_varints(out, _zigzag_deltas(np.round(coords[:, 0] / time_quantum).astype(np.int64)))
+        _write_varints(out, _zigzag_deltas(np.round(coords[:, 1] / value_quantum).astype(np.int64)))
+    return bytes(out)
+
+
+def decode_motion(data: bytes) -> Dict:
+    """二进制动作格式的参考解码器，还原为motion3.json结构"""
+    if data[:4] != b"L2MB":
+        raise ValueError("不是二进制动作文件")
+    version, header_len = struct.unpack_from("<BI", data, 4)
+    if version != 1:
+        raise ValueError(f"不支持的版本: {version}")
+    offset = 9
+    motion = json.loads(data[offset:offset + header_len].decode("utf-8"))
+    offset += header_len
+    encoding = motion.pop("Encoding")
+
+    for curve in motion["Curves"]:
+        (segment_count,), offset = _read_varints(data, offset, 1)
+        types = list(data[offset:offset + segment_count])
+        offset += segment_count
+        (point_count,), offset = _read_varints(data, offset, 1)
+        times, offset = _read_varints(data, offset, point_count)
+        values, offset = _read_varints(data, offset, point_count)
+        times = (_unzigzag_cumsum(times) * encoding["TimeQuantum"]).tolist()
+        values = (_unzigzag_cumsum(values) * encoding["ValueQuantum"]).tolist()
+        curve["Segments"] = join_segments(types, list(zip(times, values)))
+    return motion
+
+
+def max_motion_error(original: Dict, decoded: Dict) -> float:
+    error = 0.0
+    for a, b in zip(original["Curves"], decoded["Curves"]):
+        if a["Segments"]:
+            error = max(error, float(np.max(np.abs(np.array(a["Segments"]) - np.array(b["Segments"])))))
+    return error
+
+
+def collect_references(node, refs: List[str], key: str = None):
+    """收集FileReferences中所有文件路径（Name字段除外）"""
+    if isinstance(node, str):
+        if key != "Name":
+            refs.append(node)
+    elif isinstance(node, list):
+        for item in node:
+            collect_references(item, refs, key)
+    elif isinstance(node, dict):
+        for child_key, child in node.items():
+            collect_references(child, refs, child_key)
+
+
+def rewrite_references(node, mapping: Dict[str, str], key: str = None):
+    if isinstance(node, str):
+        return mapping.get(node, node) if key != "Name" else node
+    if isinstance(node, list):
+        return [rewrite_references(item, mapping, key) for item in node]
+    if isinstance(node, dict):
+        return {k: rewrite_references(v, mapping, k) for k, v in node.items()}
+    return node
+
+
+class AssetBuilder:
+    """资源构建器"""
+
+    def __init__(self, src: str, out: str, binary: bool, time_quantum: float, value_quantum: float):
+        self.src = os.path.abspath(src)
+        self.out = os.path.abspath(out)
+        self.binary = binary
+        self.time_quantum = time_quantum
+        self.value_quantum = value_quantum
+        self.manifest: Dict[str, Dict] = {}
+        self.handled = set()
+
+    def _write(self, rel_path: str, data: bytes) -> Dict:
+        """写入文件并预压缩，返回各编码的大小"""
+        target = os.path.join(self.out, rel_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(data)
+        sizes = {"bytes": len(data), "gzip": None, "br": None}
+
+        gz = gzip.compress(data, compresslevel=9, mtime=0)
+        # 只保留有明显收益的压缩版本（PNG、WAV等已压缩格式会被跳过）
+        if len(gz) < len(data) * 0.9:
+            with open(target + ".gz", "wb") as f:
+                f.write(gz)
+            sizes["gzip"] = len(gz)
+            if brotli is not None:
+                br = brotli.compress(data, quality=11)
+                with open(target + ".br", "wb") as f:
+                    f.write(br)
+                sizes["br"] = len(br)
+        return sizes
+
+    def build_model(self, model_path: str) -> Dict[str, int]:
+        model_dir = os.path.dirname(model_path)
+        rel_model_dir = os.path.relpath(model_dir, self.src)
+        with open(model_path, "rb") as f:
+            model_raw = f.read()
+        model = json.loads(model_raw.decode("utf-8-sig"))
+
+        refs: List[str] = []
+        collect_references(model.get("FileReferences", {}), refs)
+        report = {"json_original": len(model_raw), "json_minified": 0, "json_gzip": 0, "binary": 0, "binary_gzip": 0}
+        mapping = {}
+        max_error = 0.0
+
+        for ref in dict.fromkeys(refs):
+            source = os.path.join(model_dir, ref)
+            if not os.path.exists(source):
+                print(f"[motion_assets] 缺少引用文件: {os.path.relpath(source, self.src)}")
+                continue
+            with open(source, "rb") as f:
+                raw = f.read()
+            is_json = ref.endswith(".json")
+            data = minify_json(raw) if is_json else raw
+            digest = content_hash(data)
+            out_ref = hashed_name(ref, digest)
+            mapping[ref] = out_ref
+            rel_source = os.path.join(rel_model_dir, ref)
+            entry = {"path": os.path.join(rel_model_dir, out_ref), "sha256": digest}
+            entry.update(self._write(entry["path"], data))
+
+            if is_json:
+                report["json_original"] += len(raw)
+                report["json_minified"] += len(data)
+                report["json_gzip"] += entry["gzip"] or len(data)
+
+            if self.binary and ref.endswith(".motion3.json"):
+                motion = json.loads(data)
+                encoded = encode_motion(motion, self.time_quantum, self.value_quantum)
+                max_error = max(max_error, max_motion_error(motion, decode_motion(encoded)))
+                binary_digest = content_hash(encoded)
+                binary_path = os.path.join(rel_model_dir, hashed_name(ref[:-len(".json")] + ".bin", binary_digest))
+                binary_entry = {"path": binary_path, "sha256": binary_digest}
+                binary_entry.update(self._write(binary_path, encoded))
+                entry["binary"] = binary_entry
+                report["binary"] += len(encoded)
+                report["binary_gzip"] += binary_entry["gzip"] or len(encoded)
+
+            self.manifest[rel_source] = entry
+            self.handled.add(os.path.abspath(source))
+
+        # 入口model3.json保持原名，引用改写为带哈希的文件名
+        model["FileReferences"] = rewrite_references(model.get("FileReferences", {}), mapping)
+        model_data = json.dumps(model, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        rel_model = os.path.relpath(model_path, self.src)
+        entry = {"path": rel_model, "sha256": content_hash(model_data), "entry": True}
+        entry.update(self._write(rel_model, model_data))
+        self.manifest[rel_model] = entry
+        self.handled.add(os.path.abspath(model_path))
+        report["json_minified"] += len(model_data)
+        report["json_gzip"] += entry["gzip"] or len(model_data)
+        report["max_error"] = max_error
+        return report
+
+    def copy_remaining(self):
+        """原样复制未被模型引用的文件，使输出目录可以直接替换Resources"""
+        for root, _, files in os.walk(self.src):
+            for name in files:
+                source = os.path.abspath(os.path.join(root, name))
+                if source in self.handled:
+                    continue
+                rel = os.path.relpath(source, self.src)
+                target = os.path.join(self.out, rel)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(source, target)
+
+    def build(self):
+        if os.path.exists(self.out):
+            shutil.rmtree(self.out)
+        models = sorted(
+            os.path.join(root, name)
+            for root, _, files in os.walk(self.src)
+            for name in files if name.endswith(".model3.json")
+        )
+
+        print(f"{'模型':<10}{'JSON原始':>12}{'精简':>12}{'精简+gzip':>12}{'二进制':>12}{'二进制+gzip':>14}{'减少':>8}")
+        for model_path in models:
+            report = self.build_model(model_path)
+            reduction = 1 - report["json_gzip"] / report["json_original"] if report["json_original"] else 0.0
+            name = os.path.basename(model_path).split(".")[0]
+            binary = f"{report['binary']:>12}{report['binary_gzip']:>14}" if self.binary else f"{'-':>12}{'-':>14}"
+            print(
+                f"{name:<10}{report['json_original']:>12}{report['json_minified']:>12}"
+                f"{report['json_gzip']:>12}{binary}{reduction:>8.1%}"
+            )
+            if self.binary:
+                print(f"{'':<10}二进制量化最大误差: {report['max_error']:.6f}")
+
+        self.copy_remaining()
+        with open(os.path.join(self.out, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "files": self.manifest}, f, ensure_ascii=False, indent=1)
+        print(f"输出目录: {self.out}")
+
+
+class AssetRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """按 Accept-Encoding 返回预压缩文件，带哈希的文件使用长期缓存"""
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        accept = self.headers.get("Accept-Encoding", "")
+        if os.path.isfile(path):
+            for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if encoding in accept and os.path.isfile(path + suffix):
+                    with open(path + suffix, "rb") as f:
+                        data = f.read()
+                    self.send_response(200)
+                    self.send_header("Content-Type", self.guess_type(path))
+                    self.send_header("Content-Encoding", encoding)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.send_header("Vary", "Accept-Encoding")
+                    self.end_headers()
+                    return _BytesReader(data)
+        return super().send_head()
+
+    def end_headers(self):
+        name = os.path.basename(self.path.split("?")[0])
+        parts = name.split(".")
+        # 文件名中含10位十六进制哈希的资源内容不会变化
+        if len(parts) >= 3 and len(parts[-2]) == 10 and all(c in "0123456789abcdef" for c in parts[-2]):
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        else:
+            self.send_header("Cache-Control", "no-cache")
+        super().end_headers()
+
+
+class _BytesReader:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def read(self, *_) -> bytes:
+        data, self.data = self.data, b""
+        return data
+
+    def close(self):
+        pass
+
+
+def serve(directory: str, port: int):
+    handler = lambda *args, **kwargs: AssetRequestHandler(*args, directory=directory, **kwargs)  # noqa: E731
+    with http.server.ThreadingHTTPServer(("0.0.0.0", port), handler) as server:
+        print(f"资源服务已启动: http://0.0.0.0:{port}/ ({directory})")
+        server.serve_forever()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Live2D模型资源构建工具")
+    parser.add_argument("--src", default=DEFAULT_SRC, help="Resources目录")
+    parser.add_argument("--out", default="build/Resources", help="输出目录")
+    parser.add_argument("--binary", action="store_true", help="额外输出量化差分编码的二进制动作文件")
+    parser.add_argument("--time-quantum", type=float, default=0.001, help="二进制格式的时间量化步长（秒）")
+    parser.add_argument("--value-quantum", type=float, default=0.001, help="二进制格式的数值量化步长")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="构建后启动本地资源服务")
+    parser.add_argument("--no-build", action="store_true", help="只启动服务，不重新构建")
+    parser.add_argument("--spec", action="store_true", help="打印二进制动作格式说明")
+    args = parser.parse_args(argv)
+
+    if args.spec:
+        print(MOTION_BINARY_SPEC)
+        return
+    if not args.no_build:
+        AssetBuilder(args.src, args.out, args.binary, args.time_quantum, args.value_quantum).build()
+    if args.serve:
+        serve(os.path.abspath(args.out), args.serve)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+语音识别服务层
+将语音识别抽象为可替换的后端：SiliconFlow云端识别或本地CPU识别
+"""
+import asyncio
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+from dotenv import load_dotenv
+
+from services.http_service import http_service
+
+load_dotenv()
+
+
+class ASRBackend(ABC):
+    """语音识别后端基类，子类必须实现transcribe，否则无法实例化"""
+
+    name = "base"
+
+    async def start(self):
+        """预热后端（可选）"""
+
+    async def close(self):
+        """释放后端占用的资源（可选）"""
+
+    @abstractmethod
+    async def transcribe(self, audio_filepath: str, content_type: str = "audio/wav") -> Optional[str]:
+        """
+        识别音频文件
+
+        Args:
+            audio_filepath: 音频文件路径
+            content_type: 音频文件的MIME类型
+
+        Returns:
+            识别结果文本，失败返回None
+        """
+
+
+class SiliconFlowASRBackend(ASRBackend):
+    """SiliconFlow云端语音识别"""
+
+    name = "siliconflow"
+
+    async def transcribe(self, audio_filepath: str, content_type: str = "audio/wav") -> Optional[str]:
+        return await http_service.transcribe_audio(audio_filepath, content_type)
+
+
+# 本地识别进程内的模型实例，由进程池初始化函数加载
+_local_model = None
+
+
+def _load_local_model(model_name: str, compute_type: str, cpu_threads: int):
+    """进程池初始化：每个工作进程加载一次模型"""
+    global _local_model
+    from faster_whisper import WhisperModel
+
+    _local_model = WhisperModel(
+        model_name,
+        device="cpu",
+        compute_type=compute_type,
+        cpu_threads=cpu_threads
+    )
+    print(f"[LocalASRBackend] 工作进程 {os.getpid()} 模型加载完成: {model_name}")
+
+
+def _warmup_local_model() -> int:
+    """触发工作进程创建并确认模型已加载"""
+    return os.getpid() if _local_model is not None else 0
+
+
+def _transcribe_local(audio_filepath: str, language: Optional[str]) -> str:
+    """在工作进程中执行识别"""
+    segments, _ = _local_model.transcribe(audio_filepath, language=language, beam_size=1, vad_filter=True)
+    return "".join(segment.text for segment in segments).strip()
+
+
+class LocalASRBackend(ASRBackend):
+    """本地CPU语音识别（faster-whisper），在进程池中运行以免占用事件循环"""
+
+    name = "local"
+
+    def __init__(self):
+        self.model_name = os.getenv("LOCAL_ASR_MODEL", "small")
+        self.compute_type = os.getenv("LOCAL_ASR_COMPUTE_TYPE", "int8")
+        self.workers = int(os.getenv("LOCAL_ASR_WORKERS", "1"))
+        self.cpu_threads = int(os.getenv("LOCAL_ASR_THREADS", "2"))
+        self.language = os.getenv("LOCAL_ASR_LANGUAGE", "zh") or None
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_load_local_model,
+                initargs=(self.model_name, self.compute_type, self.cpu_threads)
+            )
+        return self.executor
+
+    async def start(self):
+        """启动所有工作进程并预加载模型，避免首次识别时的冷启动"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        pids = await asyncio.gather(*[
+            loop.run_in_executor(executor, _warmup_local_model)
+            for _ in range(self.workers)
+        ])
+        print(f"[LocalASRBackend] 进程池已就绪，工作进程: {sorted(set(pids))}")
+
+    async def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def transcribe(self, audio_filepath: str, content_type: str = "audio/wav") -> Optional[str]:
+        try:
+            loop = asyncio.get_running_loop()
+            transcription = await loop.run_in_executor(
+                self._get_executor(), _transcribe_local, audio_filepath, self.language
+            )
+            print(f"[LocalASRBackend] 语音识别结果: {transcription}")
+            return transcription
+        except Exception as e:
+            print(f"[LocalASRBackend] 语音识别过程出错: {str(e)}")
+            return None
+
+
+ASR_BACKENDS = {
+    SiliconFlowASRBackend.name: SiliconFlowASRBackend,
+    LocalASRBackend.name: LocalASRBackend,
+}
+
+
+class ASRService:
+    """语音识别服务类，按配置选择后端"""
+
+    def __init__(self, backend_name: str = None):
+        backend_name = (backend_name or os.getenv("ASR_BACKEND", "siliconflow")).lower()
+        if backend_name not in ASR_BACKENDS:
+            print(f"[ASRService] 未知的语音识别后端 {backend_name}，使用 siliconflow")
+            backend_name = SiliconFlowASRBackend.name
+        self.backend: ASRBackend = ASR_BACKENDS[backend_name]()
+        print(f"[ASRService] 使用语音识别后端: {self.backend.name}")
+
+    async def start(self):
+        await self.backend.start()
+
+    async def close(self):
+        await self.backend.close()
+
+    async def transcribe_audio(self, audio_filepath: str, content_type: str = "audio/wav") -> Optional[str]:
+        """
+        语音识别
+
+        Args:
+            audio_filepath: 音频文件路径
+            content_type: 音频文件的MIME类型
+
+        Returns:
+            识别结果文本，失败返回None
+        """
+        return await self.backend.transcribe(audio_filepath, content_type)
+
+
+def create_backends(names) -> Dict[str, ASRBackend]:
+    """按名称创建多个后端实例（用于基准测试）"""
+    return {name: ASR_BACKENDS[name]() for name in names}
+
+
+# 创建全局实例
+asr_service = ASRService()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+对话历史存储
+每个客户端的历史只保存角色码和文本，调用大模型时再按需转换为对应的消息格式，
+转换结果为字典的提供商（智谱AI）缓存已转换的部分，每轮只转换新增的消息；
+LangChain消息对象每条都比原始文本大得多，缓存会抵消紧凑存储节省的内存，因此每次调用时重新构造
+"""
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+# 角色码
+ROLE_SYSTEM = 0
+ROLE_USER = 1
+ROLE_ASSISTANT = 2
+
+ROLE_NAMES = ("system", "user", "assistant")
+LANGCHAIN_MESSAGES = (SystemMessage, HumanMessage, AIMessage)
+
+# 各大模型提供商的消息格式转换函数
+CONVERTERS: Dict[str, Callable[[int, str], object]] = {
+    "openai": lambda role, text: LANGCHAIN_MESSAGES[role](content=text),
+    "zhipu": lambda role, text: {"role": ROLE_NAMES[role], "content": text},
+}
+
+# 缓存转换结果的提供商
+CACHED_PROVIDERS = frozenset({"zhipu"})
+
+
+def convert_message(provider: str, role: int, text: str):
+    """将单条消息转换为指定提供商的格式"""
+    return CONVERTERS[provider](role, text)
+
+
+class ChatHistory:
+    """单个客户端的对话历史：角色码数组和文本列表"""
+
+    __slots__ = ("roles", "texts", "_converted")
+
+    def __init__(self):
+        self.roles = bytearray()
+        self.texts: List[str] = []
+        # 按提供商缓存的已转换消息，与texts前缀一一对应（仅CACHED_PROVIDERS）
+        self._converted: Dict[str, list] = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def append(self, role: int, text: str):
+        self.roles.append(role)
+        self.texts.append(text)
+
+    def convert(self, provider: str, window: Optional[int] = None) -> list:
+        """
+        转换为指定提供商的消息列表
+
+        Args:
+            provider: 大模型提供商
+            window: 只转换最近的若干条消息（可选）
+
+        Returns:
+            新的消息列表；缓存的提供商只转换上次之后新增的消息，列表中的消息对象为缓存，调用方不能修改
+        """
+        converter = CONVERTERS[provider]
+        start = max(len(self.texts) - window, 0) if window is not None else 0
+        if provider not in CACHED_PROVIDERS:
+            return [converter(self.roles[i], self.texts[i]) for i in range(start, len(self.texts))]
+        converted = self._converted.get(provider)
+        if converted is None:
+            converted = self._converted[provider] = []
+        for i in range(len(converted), len(self.texts)):
+            converted.append(converter(self.roles[i], self.texts[i]))
+        return converted[start:]
@@ -3,11 +3,15 @@
 HTTP服务层
 负责所有HTTP请求的逻辑
 """
+import asyncio
 import httpx
 import os
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, Optional, Tuple
+import aiofiles
 from dotenv import load_dotenv
 
+from services.tts_pool import tts_pool, strip_id3
+
 load_dotenv()
 
 
@@ -16,8 +20,11 @@ class HTTPService:
 
     def __init__(self):
         """初始化HTTP服务"""
-        self.tts_api_url = os.getenv("TTS_API_URL", "http://localhost:3000")
         self.audio_url = os.getenv("AUDIO_URL", "http://localhost:3000")
+        self.audio_dir = os.getenv("AUDIO_DIR", "audio_files")
+        # TTS服务的流式合成接口（可选），未配置时先合成完整文件再分块读取
+        self.tts_stream_path = os.getenv("TTS_STREAM_PATH", "")
+        self.stream_chunk_size = int(os.getenv("TTS_STREAM_CHUNK_SIZE", "16384"))
 
     async def post(
         self,
@@ -93,6 +100,20 @@ class HTTPService:
             print(f"[HTTPService] POST请求异常: {str(e)}")
             return None
 
+    @staticmethod
+    def _tts_payload(text: str) -> Dict:
+        return {
+            "text": text,
+            "voice": "zh-CN-XiaoxiaoNeural",
+            "rate": "0%",
+            "pitch": "0Hz",
+            "volume": "0%"
+        }
+
+    async def _request_tts(self, text: str) -> Tuple[Optional[str], Optional[str]]:
+        """通过TTS实例池合成音频，返回 (服务端的音频路径, 实例地址)"""
+        return await tts_pool.synthesize(text, self._tts_payload)
+
     async def generate_tts_audio(self, text: str) -> Optional[str]:
         """
         生成TTS音频
@@ -104,20 +125,8 @@ class HTTPService:
             音频URL，失败返回None
         """
         try:
-            response = await self.post(
-                f"{self.tts_api_url}/api/v1/tts/generate",
-                json_data={
-                    "text": text,
-                    "voice": "zh-CN-XiaoxiaoNeural",
-                    "rate": "0%",
-                    "pitch": "0Hz",
-                    "volume": "0%"
-                },
-                timeout=30.0
-            )
-
-            if response and response.get("success"):
-                audio_file = response["data"]["audio"]
+            audio_file, _ = await self._request_tts(text)
+            if audio_file:
                 return f"{self.audio_url}{audio_file}"
 
             return None
@@ -125,12 +134,99 @@ class HTTPService:
             print(f"[HTTPService] TTS音频生成失败: {str(e)}")
             return None
 
-    async def transcribe_audio(self, audio_filepath: str) -> Optional[str]:
+    async def generate_tts_audio_with_lipsync(self, text: str) -> Tuple[Optional[str], Optional[Dict]]:
+        """
+        生成TTS音频并计算口型包络
+
+        Args:
+            text: 要转换的文本
+
+        Returns:
+            (音频URL, 口型包络)，失败时对应项为None
+        """
+        from services.lipsync_service import lipsync_service
+
+        try:
+            audio_file, endpoint_url = await self._request_tts(text)
+            if not audio_file:
+                return None, None
+
+            lipsync = await lipsync_service.get_envelope(audio_file, f"{endpoint_url}{audio_file}")
+            return f"{self.audio_url}{audio_file}", lipsync
+        except Exception as e:
+            print(f"[HTTPService] TTS音频生成失败: {str(e)}")
+            return None, None
+
+    async def stream_tts_audio(self, text: str) -> AsyncIterator[bytes]:
+        """
+        流式获取TTS音频，收到第一块数据即可开始播放
+
+        Args:
+            text: 要转换的文本
+
+        Yields:
+            音频数据块（MP3）
+        """
+        try:
+            if self.tts_stream_path:
+                async with tts_pool.lease() as endpoint:
+                    async with tts_pool.client.stream(
+                        "POST",
+                        f"{endpoint.url}{self.tts_stream_path}",
+                        json=self._tts_payload(text),
+                        timeout=30.0
+                    ) as response:
+                        if response.status_code != 200:
+                            raise RuntimeError(f"TTS流式请求失败: {response.status_code}")
+                        async for chunk in response.aiter_bytes(self.stream_chunk_size):
+                            yield chunk
+                return
+
+            # 长回复拆分后各段同时开始合成，按顺序推送，第一段完成即可开始播放
+            tasks = [
+                asyncio.create_task(tts_pool.generate(segment, self._tts_payload))
+                for segment in tts_pool.split(text)
+            ]
+            try:
+                for index, task in enumerate(tasks):
+                    audio_file, endpoint_url = await task
+                    if not audio_file:
+                        return
+                    strip = index > 0
+                    async for chunk in self._read_tts_audio(audio_file, endpoint_url):
+                        if strip:
+                            chunk = strip_id3(chunk)
+                            strip = False
+                        yield chunk
+            finally:
+                for task in tasks:
+                    task.cancel()
+        except Exception as e:
+            print(f"[HTTPService] TTS音频流获取失败: {str(e)}")
+
+    async def _read_tts_audio(self, audio_file: str, endpoint_url: str) -> AsyncIterator[bytes]:
+        """分块读取合成结果，优先直接读取共享目录中的文件，省去一次HTTP往返"""
+        local_path = os.path.join(self.audio_dir, os.path.basename(audio_file))
+        if os.path.exists(local_path):
+            async with aiofiles.open(local_path, "rb") as f:
+                while True:
+                    chunk = await f.read(self.stream_chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            return
+
+        async with tts_pool.client.stream("GET", f"{endpoint_url}{audio_file}", timeout=30.0) as response:
+            async for chunk in response.aiter_bytes(self.stream_chunk_size):
+                yield chunk
+
+    async def transcribe_audio(self, audio_filepath: str, content_type: str = "audio/wav") -> Optional[str]:
         """
         语音识别
 
         Args:
             audio_filepath: 音频文件路径
+            content_type: 音频文件的MIME类型
 
         Returns:
             识别结果文本，失败返回None
@@ -148,7 +244,7 @@ class HTTPService:
         try:
             with open(audio_filepath, "rb") as audio_file:
                 files = {
-                    "file": (os.path.basename(audio_filepath), audio_file, "audio/wav"),
+                    "file": (os.path.basename(audio_filepath), audio_file, content_type),
                     "model": (None, "FunAudioLLM/SenseVoiceSmall")
                 }
 
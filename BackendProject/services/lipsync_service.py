@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+口型同步服务层
+根据TTS音频预先计算口型幅度包络，随回复消息一起下发，前端无需实时分析音频
+"""
+import asyncio
+import base64
+import os
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import httpx
+import numpy as np
+from dotenv import load_dotenv
+
+from handlers.audio_normalizer import audio_normalizer
+
+load_dotenv()
+
+
+class LipSyncService:
+    """口型包络计算与缓存"""
+
+    def __init__(self):
+        self.enabled = os.getenv("LIPSYNC_ENABLED", "true").lower() == "true"
+        # 包络帧率、增益（与前端RMS计算保持一致的×5）和缓存条目数
+        self.fps = int(os.getenv("LIPSYNC_FPS", "30"))
+        self.gain = float(os.getenv("LIPSYNC_GAIN", "5.0"))
+        self.cache_size = int(os.getenv("LIPSYNC_CACHE_SIZE", "512"))
+        self.audio_dir = os.getenv("AUDIO_DIR", "audio_files")
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+    def compute_envelope(self, samples: np.ndarray, rate: int) -> bytes:
+        """
+        按固定帧率分帧计算RMS幅度，量化为uint8
+
+        Args:
+            samples: 单声道float32采样
+            rate: 采样率
+
+        Returns:
+            每帧一个字节的包络（0-255对应嘴部开合0-1）
+        """
+        hop = max(int(round(rate / self.fps)), 1)
+        frame_count = -(-samples.size // hop)
+        if frame_count == 0:
+            return b""
+        padded = np.zeros(frame_count * hop, dtype=np.float32)
+        padded[:samples.size] = samples
+        frames = padded.reshape(frame_count, hop)
+        rms = np.sqrt(np.mean(np.square(frames), axis=1))
+        level = np.minimum(rms * self.gain, 1.0)
+        return np.round(level * 255).astype(np.uint8).tobytes()
+
+    def _sidecar_path(self, audio_file: str) -> str:
+        return os.path.join(self.audio_dir, f"{os.path.basename(audio_file)}.lipsync{self.fps}")
+
+    def _load_audio(self, audio_file: str) -> Optional[bytes]:
+        """优先从共享的audio_files目录读取TTS文件"""
+        local_path = os.path.join(self.audio_dir, os.path.basename(audio_file))
+        if os.path.exists(local_path):
+            with open(local_path, "rb") as f:
+                return f.read()
+        return None
+
+    def _read_sidecar(self, sidecar: str) -> Optional[bytes]:
+        if os.path.exists(sidecar):
+            with open(sidecar, "rb") as f:
+                return f.read()
+        return None
+
+    def _write_sidecar(self, sidecar: str, envelope: bytes):
+        # 与音频文件放在一起，由存储清理任务一并回收
+        if os.path.isdir(self.audio_dir):
+            with open(sidecar, "wb") as f:
+                f.write(envelope)
+
+    def _compute_from_bytes(self, audio_data: bytes) -> Optional[bytes]:
+        samples, rate = audio_normalizer.decode_mono(audio_data)
+        if samples is None:
+            return None
+        return self.compute_envelope(samples, rate)
+
+    def _remember(self, key: str, envelope: bytes):
+        self._cache[key] = envelope
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def get_envelope(self, audio_file: str, remote_url: str = None) -> Optional[Dict]:
+        """
+        获取TTS音频的口型包络，每个音频只计算一次
+
+        Args:
+            audio_file: TTS服务返回的音频路径
+            remote_url: 本地不存在该文件时的下载地址
+
+        Returns:
+            {"fps": 帧率, "data": base64编码的uint8包络}，失败返回None
+        """
+        if not self.enabled:
+            return None
+        try:
+            envelope = self._cache.get(audio_file)
+            if envelope is None:
+                # 文件读写放到线程中执行，避免阻塞事件循环
+                sidecar = self._sidecar_path(audio_file)
+                envelope = await asyncio.to_thread(self._read_sidecar, sidecar)
+                if envelope is None:
+                    audio_data = await asyncio.to_thread(self._load_audio, audio_file)
+                    if audio_data is None and remote_url:
+                        async with httpx.AsyncClient() as client:
+                            response = await client.get(remote_url, timeout=10.0)
+                            response.raise_for_status()
+                            audio_data = response.content
+                    if audio_data is None:
+                        return None
+                    envelope = await asyncio.to_thread(self._compute_from_bytes, audio_data)
+                    if envelope is None:
+                        return None
+                    await asyncio.to_thread(self._write_sidecar, sidecar, envelope)
+            self._remember(audio_file, envelope)
+            return {"fps": self.fps, "data": base64.b64encode(envelope).decode("ascii")}
+        except Exception as e:
+            print(f"[LipSyncService] 口型包络计算失败: {str(e)}")
+            return None
+
+
+# 创建全局实例
+lipsync_service = LipSyncService()
@@ -3,14 +3,22 @@
 大模型服务层
 负责所有与大模型交互的逻辑
 """
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.messages import BaseMessage
+import asyncio
 import os
+import threading
 import base64
+import time
 from dotenv import load_dotenv
 from zhipuai import ZhipuAI
 
+from services.history_service import ChatHistory, ROLE_SYSTEM, ROLE_USER, convert_message
+from services.usage_service import (
+    usage_tracker, usage_from_openai, usage_from_zhipu, estimate_tokens, CALL_CHAT, CALL_ANIMATION, CALL_PHOTO, CALL_IMAGE
+)
+
 load_dotenv()
 
 
@@ -21,7 +29,15 @@ class LLMService:
         """初始化大模型客户端"""
         self.model_type = os.getenv("MODEL_TYPE", "openai")
         self.llm = None
+        # 负载较高时对话使用的快速模型（可选）
+        self.fast_llm = None
         self.zhipu_client = None
+        self.zhipu_chat_model = os.getenv("ZHIPU_CHAT_MODEL", "glm-4.7-flash")
+        self.zhipu_fast_model = os.getenv("ZHIPU_FAST_MODEL", "")
+        # 消息格式与对话使用的提供商一致
+        self.provider = "zhipu" if self.model_type == "zhipu" else "openai"
+        # 已转换的系统提示词，按 (提供商, 提示词) 复用
+        self._system_messages: Dict[Tuple[str, str], object] = {}
 
         if self.model_type == "zhipu":
             self._initialize_zhipu_client()
@@ -36,9 +52,20 @@ class LLMService:
                 model=os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"),
                 temperature=0.7,
                 api_key=os.getenv("OPENAI_API_KEY"),
-                base_url=os.getenv("OPENAI_BASE_URL")
+                base_url=os.getenv("OPENAI_BASE_URL"),
+                stream_usage=True
             )
             print(f"[LLMService] OpenAI客户端初始化成功 (模型: {os.getenv('OPENAI_MODEL')})")
+            fast_model = os.getenv("OPENAI_FAST_MODEL")
+            if fast_model:
+                self.fast_llm = ChatOpenAI(
+                    model=fast_model,
+                    temperature=0.7,
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    base_url=os.getenv("OPENAI_BASE_URL"),
+                    stream_usage=True
+                )
+                print(f"[LLMService] 快速模型: {fast_model}")
         except Exception as e:
             print(f"[LLMService] OpenAI客户端初始化失败: {str(e)}")
             self.llm = None
@@ -56,63 +83,229 @@ class LLMService:
         else:
             print("[LLMService] 未配置ZHIPUAI_API_KEY或使用默认值")
 
+    def _system_message(self, system_prompt: str):
+        key = (self.provider, system_prompt)
+        message = self._system_messages.get(key)
+        if message is None:
+            # 提示词种类有限（对话、动画、拍照，动画提示词按模型区分），缓存不会无限增长
+            message = self._system_messages[key] = convert_message(self.provider, ROLE_SYSTEM, system_prompt)
+        return message
+
+    def build_messages(
+        self,
+        history: ChatHistory,
+        text: str = None,
+        system_prompt: str = None,
+        window: Optional[int] = None
+    ) -> list:
+        """
+        组装发送给大模型的消息列表：系统提示词 + 历史消息 + 当前用户消息
+
+        Args:
+            history: 对话历史
+            text: 当前用户消息（可选）
+            system_prompt: 系统提示词（可选）
+            window: 只保留最近的若干条历史消息（可选）
+
+        Returns:
+            当前提供商格式的消息列表
+        """
+        messages = [self._system_message(system_prompt)] if system_prompt else []
+        messages += history.convert(self.provider, window)
+        if text:
+            messages.append(convert_message(self.provider, ROLE_USER, text))
+        return messages
+
+    def _zhipu_model(self, fast: bool) -> str:
+        return self.zhipu_fast_model if fast and self.zhipu_fast_model else self.zhipu_chat_model
+
+    def _openai_llm(self, fast: bool):
+        return self.fast_llm if fast and self.fast_llm else self.llm
+
+    async def _complete(self, messages: list, fast: bool = False, call_type: str = CALL_CHAT) -> str:
+        if self.model_type == "zhipu":
+            return await self._chat_with_zhipu(messages, self._zhipu_model(fast), call_type)
+        return await self._chat_with_openai(messages, self._openai_llm(fast), call_type)
+
     async def chat(
         self,
-        messages: List[BaseMessage],
-        system_prompt: str = None
+        history: ChatHistory,
+        text: str = None,
+        system_prompt: str = None,
+        window: Optional[int] = None,
+        fast: bool = False
     ) -> str:
         """
         调用大模型进行对话
 
         Args:
-            messages: 消息列表
+            history: 对话历史
+            text: 当前用户消息
             system_prompt: 系统提示词（可选）
+            window: 只发送最近的若干条历史消息（可选）
+            fast: 是否使用快速模型（未配置时使用默认模型）
 
         Returns:
             模型回复内容
         """
         try:
-            # 如果提供了系统提示词，添加到消息列表开头
-            if system_prompt:
-                final_messages = [SystemMessage(content=system_prompt)] + messages
-            else:
-                final_messages = messages
-
-            if self.model_type == "zhipu":
-                return await self._chat_with_zhipu(final_messages)
-            else:
-                return await self._chat_with_openai(final_messages)
+            return await self._complete(self.build_messages(history, text, system_prompt, window), fast)
         except Exception as e:
             print(f"[LLMService] 大模型调用失败: {str(e)}")
             raise
 
-    async def _chat_with_openai(self, messages: List[BaseMessage]) -> str:
+    async def chat_stream(
+        self,
+        history: ChatHistory,
+        text: str = None,
+        system_prompt: str = None,
+        window: Optional[int] = None,
+        fast: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        流式调用大模型，逐段返回回复内容
+
+        Args:
+            history: 对话历史
+            text: 当前用户消息
+            system_prompt: 系统提示词（可选）
+            window: 只发送最近的若干条历史消息（可选）
+            fast: 是否使用快速模型（未配置时使用默认模型）
+
+        Yields:
+            回复内容片段
+        """
+        messages = self.build_messages(history, text, system_prompt, window)
+        if self.model_type == "zhipu":
+            async for delta in self._stream_with_zhipu(messages, self._zhipu_model(fast)):
+                yield delta
+            return
+
+        llm = self._openai_llm(fast)
+        if not llm:
+            raise Exception("OpenAI客户端未初始化")
+        start = time.perf_counter()
+        usage = None
+        received = []
+        try:
+            async for chunk in llm.astream(messages):
+                # 用量在最后一个数据块中返回
+                if chunk.usage_metadata:
+                    usage = usage_from_openai(chunk)
+                if chunk.content:
+                    received.append(chunk.content)
+                    yield chunk.content
+        finally:
+            self._record_stream("openai", llm.model_name, usage, [m.content for m in messages], received, start)
+
+    @staticmethod
+    def _record_stream(provider: str, model: str, usage, prompts: list, received: List[str], start: float):
+        """记录流式调用的用量；流被中途取消或上游未返回用量时，按发送和已收到的文本长度估算"""
+        estimated = usage is None
+        if estimated:
+            usage = (sum(estimate_tokens(str(prompt)) for prompt in prompts), estimate_tokens("".join(received)), 0)
+        usage_tracker.record(
+            CALL_CHAT, provider, model, *usage, (time.perf_counter() - start) * 1000, estimated=estimated
+        )
+
+    async def _stream_with_zhipu(self, messages: List[Dict[str, str]], model: str) -> AsyncIterator[str]:
+        """智谱AI的流式接口是同步迭代器，在线程中读取并通过队列转交给事件循环"""
+        if not self.zhipu_client:
+            raise Exception("智谱AI客户端未初始化")
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        finished = object()
+        usage = []
+        start = time.perf_counter()
+        # 生成器被关闭或取消时通知读取线程停止，避免继续占用线程读取上游响应
+        stopped = threading.Event()
+
+        def produce():
+            response = None
+            try:
+                response = self.zhipu_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                )
+                for chunk in response:
+                    if stopped.is_set():
+                        break
+                    # 用量在最后一个数据块中返回
+                    if chunk.usage is not None:
+                        usage.append(chunk.usage)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        loop.call_soon_threadsafe(queue.put_nowait, delta)
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+            except Exception as e:
+                if not stopped.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                # 提前停止时关闭底层HTTP连接（智谱SDK的流式响应对象通过response属性持有httpx响应）
+                if stopped.is_set() and response is not None:
+                    close = getattr(response, "close", None) or getattr(getattr(response, "response", None), "close", None)
+                    try:
+                        if callable(close):
+                            close()
+                    except Exception as e:
+                        print(f"[LLMService] 关闭智谱AI流式响应失败: {str(e)}")
+
+        producer = loop.run_in_executor(None, produce)
+        received = []
+        try:
+            while True:
+                item = await queue.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                received.append(item)
+                yield item
+            await producer
+        finally:
+            stopped.set()
+            self._record_stream(
+                "zhipu", model, usage_from_zhipu(usage[-1]) if usage else None,
+                [message.get("content", "") for message in messages], received, start
+            )
+
+    async def _chat_with_openai(self, messages: List[BaseMessage], llm=None, call_type: str = CALL_CHAT) -> str:
         """使用OpenAI进行对话"""
-        if not self.llm:
+        llm = llm or self.llm
+        if not llm:
             raise Exception("OpenAI客户端未初始化")
-        response = await self.llm.ainvoke(messages)
+        start = time.perf_counter()
+        response = await llm.ainvoke(messages)
+        usage_tracker.record(
+            call_type, "openai", llm.model_name, *usage_from_openai(response), (time.perf_counter() - start) * 1000
+        )
         return response.content
 
-    async def _chat_with_zhipu(self, messages: List[BaseMessage]) -> str:
-        """使用智谱AI进行对话"""
+    async def _chat_with_zhipu(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = None,
+        call_type: str = CALL_CHAT
+    ) -> str:
+        """使用智谱AI进行对话（消息已是智谱AI格式）"""
         if not self.zhipu_client:
             raise Exception("智谱AI客户端未初始化")
 
-        # 转换LangChain消息格式为智谱AI格式
-        zhipu_messages = []
-        for msg in messages:
-            if isinstance(msg, SystemMessage):
-                zhipu_messages.append({"role": "system", "content": msg.content})
-            elif hasattr(msg, 'role'):
-                zhipu_messages.append({"role": msg.role, "content": msg.content})
-            else:
-                zhipu_messages.append({"role": "user", "content": msg.content})
-
-        response = self.zhipu_client.chat.completions.create(
-            model="glm-4.7-flash",
-            messages=zhipu_messages,
+        model = model or self.zhipu_chat_model
+        start = time.perf_counter()
+        # 智谱AI SDK是同步阻塞调用，放到线程中执行，避免阻塞事件循环（也会被降级控制误判为过载）
+        response = await asyncio.to_thread(
+            self.zhipu_client.chat.completions.create,
+            model=model,
+            messages=messages,
             stream=False,
         )
+        usage_tracker.record(
+            call_type, "zhipu", model, *usage_from_zhipu(getattr(response, "usage", None)),
+            (time.perf_counter() - start) * 1000
+        )
 
         if hasattr(response, 'choices') and len(response.choices) > 0:
             return response.choices[0].message.content
@@ -155,7 +348,9 @@ class LLMService:
             image_base64 = base64.b64encode(image_bytes).decode('utf-8')
 
             # 调用智谱AI的GLM-4V-Flash模型
-            response = self.zhipu_client.chat.completions.create(
+            start = time.perf_counter()
+            response = await asyncio.to_thread(
+                self.zhipu_client.chat.completions.create,
                 model="glm-4.6v-flash",
                 messages=[
                     {
@@ -176,6 +371,10 @@ class LLMService:
                 ],
                 stream=False,
             )
+            usage_tracker.record(
+                CALL_IMAGE, "zhipu", "glm-4.6v-flash", *usage_from_zhipu(getattr(response, "usage", None)),
+                (time.perf_counter() - start) * 1000
+            )
 
             # 提取分析结果
             if hasattr(response, 'choices') and len(response.choices) > 0:
@@ -192,15 +391,19 @@ class LLMService:
 
     async def get_animation_index(
         self,
-        messages: List[BaseMessage],
-        model_name: str
+        history: ChatHistory,
+        text: str,
+        model_name: str,
+        window: Optional[int] = None
     ) -> int:
         """
         根据对话内容获取动画索引
 
         Args:
-            messages: 消息列表
+            history: 对话历史
+            text: 当前用户消息
             model_name: Live2D模型名称
+            window: 只发送最近的若干条历史消息（可选）
 
         Returns:
             动画索引
@@ -235,11 +438,9 @@ class LLMService:
            """
 
         try:
-            final_messages = [SystemMessage(content=system_prompt)] + messages
-            if self.model_type == "zhipu":
-                response = await self._chat_with_zhipu(final_messages)
-            else:
-                response = await self._chat_with_openai(final_messages)
+            response = await self._complete(
+                self.build_messages(history, text, system_prompt, window), call_type=CALL_ANIMATION
+            )
             animation_index = response.strip()
             return int(animation_index)
         except Exception as e:
@@ -248,13 +449,17 @@ class LLMService:
 
     async def should_take_photo(
         self,
-        messages: List[BaseMessage]
+        history: ChatHistory,
+        text: str,
+        window: Optional[int] = None
     ) -> bool:
         """
         根据对话内容判断是否需要拍照
 
         Args:
-            messages: 消息列表
+            history: 对话历史
+            text: 当前用户消息
+            window: 只发送最近的若干条历史消息（可选）
 
         Returns:
             是否需要拍照（True/False）
@@ -276,11 +481,9 @@ class LLMService:
 """
 
         try:
-            final_messages = [SystemMessage(content=system_prompt)] + messages
-            if self.model_type == "zhipu":
-                response = await self._chat_with_zhipu(final_messages)
-            else:
-                response = await self._chat_with_openai(final_messages)
+            response = await self._complete(
+                self.build_messages(history, text, system_prompt, window), call_type=CALL_PHOTO
+            )
             result = response.strip().lower()
             print(f"[LLMService] 拍照判断结果: {result}")
             return result == "true"
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+自适应降级控制
+根据事件循环延迟、进行中的对话轮次数和上游调用p95延迟判断负载压力，
+压力过高时逐级启用降级措施（默认动画、跳过拍照判断、缩短历史、切换快速模型、只回复文字），
+压力持续回落后再逐级恢复
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 可用的降级措施
+STEP_ANIMATION = "animation"    # 使用默认动画，不调用 get_animation_index
+STEP_PHOTO = "photo"            # 跳过 should_take_photo
+STEP_HISTORY = "history"        # 只发送最近的若干条历史消息
+STEP_FAST_MODEL = "fast_model"  # 对话切换到快速模型
+STEP_TEXT_ONLY = "text_only"    # 只回复文字，不合成语音
+STEPS = (STEP_ANIMATION, STEP_PHOTO, STEP_HISTORY, STEP_FAST_MODEL, STEP_TEXT_ONLY)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class Degradation:
+    """当前级别启用的降级措施"""
+
+    __slots__ = ("level", "default_animation", "skip_photo", "history_window", "fast_model", "text_only")
+
+    def __init__(self, level: int, steps, history_window: int):
+        self.level = level
+        self.default_animation = STEP_ANIMATION in steps
+        self.skip_photo = STEP_PHOTO in steps
+        self.history_window = history_window if STEP_HISTORY in steps else None
+        self.fast_model = STEP_FAST_MODEL in steps
+        self.text_only = STEP_TEXT_ONLY in steps
+
+
+class LoadShedder:
+    """降级控制器
+
+    每个评估周期计算压力值（各信号与阈值之比的最大值）：压力不低于1且在当前级别停留超过
+    LOAD_SHED_ESCALATE_SECONDS 时升一级；压力持续低于 LOAD_SHED_RECOVER_RATIO 达到
+    LOAD_SHED_RECOVER_SECONDS 时降一级。升降阈值和停留时间的差异避免级别来回抖动。
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("LOAD_SHED_ENABLED", "true").lower() == "true"
+        # 级别n启用前n项降级措施
+        steps = [s.strip() for s in os.getenv("LOAD_SHED_STEPS", ",".join(STEPS)).split(",") if s.strip()]
+        unknown = [s for s in steps if s not in STEPS]
+        if unknown:
+            print(f"[LoadShedder] 忽略未知的降级措施: {', '.join(unknown)}")
+        self.steps = [s for s in steps if s in STEPS]
+        self.history_window = int(os.getenv("LOAD_SHED_HISTORY_WINDOW", "6"))
+        self.default_animation_index = int(os.getenv("LOAD_SHED_ANIMATION_INDEX", "1"))
+
+        # 各信号的阈值
+        self.lag_threshold_ms = float(os.getenv("LOAD_SHED_LAG_MS", "100"))
+        self.inflight_threshold = int(os.getenv("LOAD_SHED_INFLIGHT", "20"))
+        self.upstream_threshold_ms = float(os.getenv("LOAD_SHED_UPSTREAM_P95_MS", "5000"))
+        # 上游延迟只统计最近一段时间内的调用
+        self.upstream_window = float(os.getenv("LOAD_SHED_UPSTREAM_WINDOW", "30"))
+
+        self.interval = float(os.getenv("LOAD_SHED_INTERVAL", "1"))
+        self.escalate_seconds = float(os.getenv("LOAD_SHED_ESCALATE_SECONDS", "3"))
+        self.recover_ratio = float(os.getenv("LOAD_SHED_RECOVER_RATIO", "0.6"))
+        self.recover_seconds = float(os.getenv("LOAD_SHED_RECOVER_SECONDS", "15"))
+
+        self.level = 0
+        self.inflight = 0
+        self.pressure = 0.0
+        self.signals: Dict[str, float] = {"lag_ms": 0.0, "inflight": 0, "upstream_p95_ms": 0.0}
+        # 最近的上游调用 (完成时间, 耗时ms)
+        self._upstream: deque = deque(maxlen=int(os.getenv("LOAD_SHED_UPSTREAM_SAMPLES", "500")))
+        self._lag_source: Optional[Callable[[], float]] = None
+        self._policies = [
+            Degradation(level, self.steps[:level], self.history_window) for level in range(len(self.steps) + 1)
+        ]
+
+        now = time.monotonic()
+        self._level_since = now
+        self._calm_since: Optional[float] = None
+        # 各级别累计停留时间（秒），当前级别的停留时间在读取指标时补上
+        self.seconds_at_level: List[float] = [0.0] * (len(self.steps) + 1)
+        self.transitions = {"escalations": 0, "recoveries": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    def set_lag_source(self, source: Callable[[], float]):
+        """设置事件循环延迟的读取函数（毫秒）"""
+        self._lag_source = source
+
+    def policy(self) -> Degradation:
+        """获取当前级别的降级措施"""
+        return self._policies[self.level]
+
+    def turn_started(self):
+        self.inflight += 1
+
+    def turn_finished(self):
+        self.inflight -= 1
+
+    def record_upstream(self, elapsed_ms: float):
+        """记录一次上游调用（LLM/TTS/ASR）的耗时"""
+        self._upstream.append((time.monotonic(), elapsed_ms))
+
+    def _measure(self, now: float) -> float:
+        cutoff = now - self.upstream_window
+        while self._upstream and self._upstream[0][0] < cutoff:
+            self._upstream.popleft()
+        self.signals = {
+            "lag_ms": self._lag_source() if self._lag_source else 0.0,
+            "inflight": self.inflight,
+            "upstream_p95_ms": percentile([ms for _, ms in self._upstream], 0.95),
+        }
+        return max(
+            self.signals["lag_ms"] / self.lag_threshold_ms,
+            self.signals["inflight"] / self.inflight_threshold,
+            self.signals["upstream_p95_ms"] / self.upstream_threshold_ms,
+        )
+
+    def _set_level(self, level: int, now: float):
+        self.seconds_at_level[self.level] += now - self._level_since
+        print(
+            f"[LoadShedder] 降级级别 {self.level} -> {level}，压力 {self.pressure:.2f}，"
+            f"启用: {', '.join(self.steps[:level]) or '无'}"
+        )
+        self.level = level
+        self._level_since = now
+
+    def evaluate(self, now: Optional[float] = None):
+        """评估一次负载压力并按需调整级别"""
+        now = time.monotonic() if now is None else now
+        self.pressure = self._measure(now)
+        if self.pressure >= 1.0:
+            self._calm_since = None
+            if self.level < len(self.steps) and now - self._level_since >= self.escalate_seconds:
+                self.transitions["escalations"] += 1
+                self._set_level(self.level + 1, now)
+        elif self.pressure < self.recover_ratio:
+            if self._calm_since is None:
+                self._calm_since = now
+            if self.level > 0 and now - max(self._calm_since, self._level_since) >= self.recover_seconds:
+                self.transitions["recoveries"] += 1
+                self._set_level(self.level - 1, now)
+        else:
+            self._calm_since = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.evaluate()
+
+    def start(self):
+        """启动评估任务"""
+        if not self.enabled or not self.steps or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        print(f"[LoadShedder] 降级控制已启动，降级顺序: {', '.join(self.steps)}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_metrics(self) -> Dict:
+        """获取当前级别、各信号、各级别累计停留时间和升降次数"""
+        now = time.monotonic()
+        seconds = list(self.seconds_at_level)
+        seconds[self.level] += now - self._level_since
+        return {
+            "enabled": self.enabled,
+            "level": self.level,
+            "active_steps": self.steps[:self.level],
+            "pressure": round(self.pressure, 3),
+            "signals": self.signals,
+            "seconds_at_level": {str(level): round(value, 1) for level, value in enumerate(seconds)},
+            **self.transitions,
+        }
+
+
+# 创建全局实例
+load_shedder = LoadShedder()
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+性能分析服务层
+提供事件循环延迟监控（延迟直方图 + 阻塞时的调用栈）、定时采样的CPU剖析（折叠栈格式）
+以及tracemalloc内存快照对比，用于排查线上延迟抖动和内存增长
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter, deque
+from typing import Callable, Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 延迟直方图的分桶上界（毫秒）
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class LoopMonitor:
+    """事件循环延迟监控
+
+    采样任务按固定间隔休眠，实际唤醒时间与预期的差值即为事件循环延迟；
+    看门狗线程发现采样任务超过阈值未唤醒时，抓取事件循环线程当前的调用栈和正在运行的任务。
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+        self.interval = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100")) / 1000
+        self.slow_threshold = float(os.getenv("LOOP_SLOW_CALLBACK_MS", "100")) / 1000
+        self.buckets = Counter()
+        self.samples = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        # 最近的延迟样本，供降级控制读取当前延迟
+        self.recent: deque = deque(maxlen=int(os.getenv("LOOP_RECENT_SAMPLES", "50")))
+        # 最近的阻塞事件
+        self.slow_events: deque = deque(maxlen=int(os.getenv("LOOP_SLOW_EVENTS", "50")))
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        self._pending_event: Optional[Dict] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def _record(self, lag_ms: float):
+        bound = next((b for b in LAG_BUCKETS_MS if lag_ms <= b), None)
+        self.buckets[f"le_{bound}ms" if bound else "inf"] += 1
+        self.samples += 1
+        self.total_ms += lag_ms
+        self.max_ms = max(self.max_ms, lag_ms)
+        self.recent.append(lag_ms)
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._heartbeat = time.monotonic()
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(loop.time() - start - self.interval, 0.0) * 1000
+            self._record(lag_ms)
+            # 看门狗记录的阻塞事件在事件循环恢复后补上总阻塞时长
+            event = self._pending_event
+            if event is not None:
+                event["blocked_ms"] = round(lag_ms, 1)
+                self._pending_event = None
+
+    def _capture_stall(self, stalled_for: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        task = getattr(asyncio.tasks, "_current_tasks", {}).get(self._loop)
+        coro = task.get_coro() if task is not None else None
+        event = {
+            "at": time.time(),
+            "detected_after_ms": round(stalled_for * 1000, 1),
+            "blocked_ms": None,
+            "task": task.get_name() if task is not None else None,
+            "coroutine": getattr(coro, "__qualname__", None),
+            "stack": traceback.format_stack(frame, limit=30),
+        }
+        self.slow_events.append(event)
+        self._pending_event = event
+        print(
+            f"[LoopMonitor] 事件循环阻塞超过 {event['detected_after_ms']} ms，"
+            f"任务: {event['task']}，协程: {event['coroutine']}"
+        )
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.slow_threshold / 2):
+            heartbeat = self._heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            # 每次阻塞只抓取一次调用栈
+            if stalled_for > self.slow_threshold and reported != heartbeat:
+                reported = heartbeat
+                self._capture_stall(stalled_for)
+
+    def recent_lag_ms(self) -> float:
+        """最近样本的p95延迟；事件循环正被阻塞时返回已阻塞的时长"""
+        if not self.enabled:
+            return 0.0
+        stalled_ms = max(time.monotonic() - self._heartbeat - self.interval, 0.0) * 1000
+        ordered = sorted(self.recent)
+        p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] if ordered else 0.0
+        return max(p95, stalled_ms)
+
+    def start(self):
+        """启动采样任务和看门狗线程"""
+        if not self.enabled or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._sample())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        print(f"[LoopMonitor] 事件循环监控已启动，阻塞阈值 {self.slow_threshold * 1000:.0f} ms")
+
+    async def close(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_metrics(self) -> Dict:
+        """获取延迟直方图和最近的阻塞事件"""
+        return {
+            "samples": self.samples,
+            "mean_ms": self.total_ms / self.samples if self.samples else 0.0,
+            "max_ms": self.max_ms,
+            "histogram": dict(self.buckets),
+            "slow_events": list(self.slow_events),
+        }
+
+
+class Profiler:
+    """按需CPU采样剖析和内存快照对比"""
+
+    def __init__(self):
+        self.max_seconds = float(os.getenv("PROFILE_MAX_SECONDS", "30"))
+        self.tracemalloc_frames = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+        self._capture_lock = asyncio.Lock()
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        # 内存快照时一并输出的对象统计，如连接数、历史记录条数
+        self._inspectors: Dict[str, Callable[[], Dict]] = {}
+
+    def register_inspector(self, name: str, inspector: Callable[[], Dict]):
+        """注册在内存快照中输出的对象统计函数"""
+        self._inspectors[name] = inspector
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _sample_stacks(self, seconds: float, interval: float) -> Counter:
+        """在线程中定时采样所有线程的调用栈"""
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stacks[f"{names.get(thread_id, thread_id)};{self._collapse(frame)}"] += 1
+            time.sleep(interval)
+        return stacks
+
+    async def capture_cpu(self, seconds: float, interval_ms: float = 5.0) -> str:
+        """
+        采样一段时间内的调用栈
+
+        Args:
+            seconds: 采样时长，不超过 PROFILE_MAX_SECONDS
+            interval_ms: 采样间隔（毫秒）
+
+        Returns:
+            折叠栈文本，每行 "线程;帧;帧... 次数"，可直接用于flamegraph.pl或speedscope
+        """
+        seconds = min(max(seconds, 0.1), self.max_seconds)
+        if self._capture_lock.locked():
+            raise RuntimeError("已有采样正在进行")
+        async with self._capture_lock:
+            print(f"[Profiler] 开始CPU采样 {seconds:.1f} 秒")
+            stacks = await asyncio.to_thread(self._sample_stacks, seconds, max(interval_ms, 1.0) / 1000)
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def memory_snapshot(self, top: int = 20, key_type: str = "lineno") -> Dict:
+        """
+        与上一次快照对比内存分配
+
+        第一次调用时开始跟踪并记录基线，之后每次调用返回相对上一次快照的增长最多的分配位置
+        """
+        inspectors = {name: inspector() for name, inspector in self._inspectors.items()}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+            self._baseline = self._take_snapshot()
+            print("[Profiler] tracemalloc已开始跟踪")
+            return {"status": "started", "objects": inspectors}
+
+        snapshot = self._take_snapshot()
+        stats = snapshot.compare_to(self._baseline, key_type) if self._baseline else snapshot.statistics(key_type)
+        self._baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "status": "success",
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "objects": inspectors,
+            "top": [
+                {
+                    "size_diff": getattr(stat, "size_diff", stat.size),
+                    "size": stat.size,
+                    "count_diff": getattr(stat, "count_diff", stat.count),
+                    "traceback": stat.traceback.format(limit=self.tracemalloc_frames),
+                }
+                for stat in stats[:top]
+            ],
+        }
+
+    def stop_memory(self):
+        """停止tracemalloc跟踪，释放跟踪开销"""
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._baseline = None
+
+
+# 创建全局实例
+loop_monitor = LoopMonitor()
+profiler = Profiler()
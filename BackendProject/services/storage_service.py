@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+音频存储服务层
+负责 audio_files 共享目录的分片存储、按时间和容量的保留策略以及后台清理
+"""
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Tuple
+import aiofiles
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class AudioStorageManager:
+    """音频文件存储管理类
+
+    录音文件按文件名哈希分片到多级子目录，避免单个目录文件过多；
+    分片目录数量固定，清理时只删除文件，不删除目录。
+    后台清理任务同时负责EasyVoice写入同一目录的TTS文件。
+    """
+
+    def __init__(self):
+        self.root = os.getenv("AUDIO_DIR", "audio_files")
+        self.shard_depth = int(os.getenv("AUDIO_SHARD_DEPTH", "2"))
+        self.max_age = float(os.getenv("AUDIO_RETENTION_HOURS", "24")) * 3600
+        self.max_bytes = int(float(os.getenv("AUDIO_MAX_MB", "1024")) * 1024 * 1024)
+        self.sweep_interval = float(os.getenv("AUDIO_JANITOR_INTERVAL", "60"))
+        # 每秒最多删除的文件数，以及单轮清理最多删除的文件数
+        self.delete_rate = float(os.getenv("AUDIO_DELETE_RATE", "50"))
+        self.delete_budget = int(os.getenv("AUDIO_DELETE_BUDGET", "1000"))
+
+        self._known_dirs = set()
+        self._janitor_task: Optional[asyncio.Task] = None
+        self.metrics: Dict[str, float] = {
+            "file_count": 0,
+            "total_bytes": 0,
+            "disk_free_bytes": 0,
+            "disk_total_bytes": 0,
+            "deleted_files": 0,
+            "deleted_bytes": 0,
+            "sweeps": 0,
+            "last_sweep_ms": 0.0,
+            "last_sweep_at": 0.0,
+        }
+
+    def shard_dir(self, filename: str) -> str:
+        """根据文件名哈希计算分片目录，例如 audio_files/3f/a2"""
+        digest = hashlib.md5(filename.encode("utf-8")).hexdigest()
+        parts = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.root, *parts)
+
+    def path_for(self, filename: str) -> str:
+        """获取文件的分片存储路径，目录不存在时创建"""
+        directory = self.shard_dir(filename)
+        if directory not in self._known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+        return os.path.join(directory, filename)
+
+    async def save(self, filename: str, data: bytes) -> str:
+        """
+        保存文件到分片目录
+
+        Args:
+            filename: 文件名（不含目录）
+            data: 文件内容
+
+        Returns:
+            文件路径
+        """
+        filepath = self.path_for(filename)
+        async with aiofiles.open(filepath, "wb") as f:
+            await f.write(data)
+        return filepath
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """递归扫描存储目录，返回 (修改时间, 大小, 路径) 列表"""
+        entries = []
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                stat = entry.stat(follow_symlinks=False)
+                                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        except FileNotFoundError:
+                            continue
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _select_victims(self, entries: List[Tuple[float, int, str]], now: float) -> List[Tuple[float, int, str]]:
+        """按保留策略选出待删除文件：先删超龄文件，再从最旧的开始删到容量以内"""
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        victims = []
+        for mtime, size, path in entries:
+            if now - mtime > self.max_age or total > self.max_bytes:
+                victims.append((mtime, size, path))
+                total -= size
+            else:
+                break
+        return victims[:self.delete_budget]
+
+    def _delete_batch(self, batch: List[Tuple[float, int, str]]) -> Tuple[int, int]:
+        deleted_files = 0
+        deleted_bytes = 0
+        for _, size, path in batch:
+            try:
+                os.remove(path)
+                deleted_files += 1
+                deleted_bytes += size
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"[AudioStorageManager] 删除文件失败 {path}: {str(e)}")
+        return deleted_files, deleted_bytes
+
+    async def sweep(self):
+        """执行一轮清理，删除速度受 delete_rate 限制"""
+        start = time.perf_counter()
+        entries = await asyncio.to_thread(self._scan)
+        victims = self._select_victims(entries, time.time())
+
+        batch_size = max(int(self.delete_rate // 10), 1)
+        for i in range(0, len(victims), batch_size):
+            batch = victims[i:i + batch_size]
+            deleted_files, deleted_bytes = await asyncio.to_thread(self._delete_batch, batch)
+            self.metrics["deleted_files"] += deleted_files
+            self.metrics["deleted_bytes"] += deleted_bytes
+            await asyncio.sleep(len(batch) / self.delete_rate)
+
+        if victims:
+            print(f"[AudioStorageManager] 本轮清理删除 {len(victims)} 个文件")
+
+        remaining = len(entries) - len(victims)
+        self.metrics["file_count"] = remaining
+        self.metrics["total_bytes"] = sum(size for _, size, _ in entries) - sum(size for _, size, _ in victims)
+        try:
+            usage = shutil.disk_usage(self.root)
+            self.metrics["disk_free_bytes"] = usage.free
+            self.metrics["disk_total_bytes"] = usage.total
+        except FileNotFoundError:
+            pass
+        self.metrics["sweeps"] += 1
+        self.metrics["last_sweep_ms"] = (time.perf_counter() - start) * 1000
+        self.metrics["last_sweep_at"] = time.time()
+
+    async def _janitor(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[AudioStorageManager] 清理任务异常: {str(e)}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        """启动后台清理任务"""
+        os.makedirs(self.root, exist_ok=True)
+        if self._janitor_task is None:
+            self._janitor_task = asyncio.create_task(self._janitor())
+            print(f"[AudioStorageManager] 清理任务已启动，目录: {self.root}")
+
+    async def close(self):
+        if self._janitor_task is not None:
+            self._janitor_task.cancel()
+            try:
+                await self._janitor_task
+            except asyncio.CancelledError:
+                pass
+            self._janitor_task = None
+
+    def get_metrics(self) -> Dict[str, float]:
+        """获取磁盘占用和清理统计"""
+        return dict(self.metrics)
+
+
+# 创建全局实例
+audio_storage = AudioStorageManager()
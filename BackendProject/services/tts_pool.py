@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+TTS实例池
+将合成请求分发到多个EasyVoice实例：选择未完成请求最少的实例，定期健康检查，
+连续失败的实例暂时摘除；长回复按句拆分后在不同实例上并行合成，再按顺序拼接
+"""
+import asyncio
+import contextlib
+import os
+import posixpath
+import re
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+import aiofiles
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 句子结束符，拆分后标点保留在句尾
+SENTENCE_END = re.compile(r"(?<=[。！？!?；;…\n])")
+
+
+def split_sentences(text: str, max_chars: int) -> List[str]:
+    """按句拆分文本，相邻短句合并到不超过max_chars（单句超长时保持完整）"""
+    segments = []
+    current = ""
+    for piece in SENTENCE_END.split(text):
+        if not piece.strip():
+            current += piece
+            continue
+        if current.strip() and len(current) + len(piece) > max_chars:
+            segments.append(current)
+            current = piece
+        else:
+            current += piece
+    if current.strip():
+        segments.append(current)
+    return segments or [text]
+
+
+def strip_id3(data: bytes) -> bytes:
+    """去掉MP3开头的ID3v2标签，拼接的后续片段不能在中间带标签"""
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return data[10 + size + footer:]
+    return data
+
+
+class TTSEndpoint:
+    """单个TTS实例的状态"""
+
+    __slots__ = ("url", "outstanding", "healthy", "failures", "ejected_until", "requests", "errors", "total_ms")
+
+    def __init__(self, url: str):
+        self.url = url
+        # 已发出未完成的请求数，即该实例的排队长度
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.total_ms = 0.0
+
+
+class TTSPool:
+    """TTS实例池"""
+
+    def __init__(self):
+        urls = os.getenv("TTS_API_URLS") or os.getenv("TTS_API_URL", "http://localhost:3000")
+        self.endpoints = [TTSEndpoint(url.strip().rstrip("/")) for url in urls.split(",") if url.strip()]
+        self.generate_path = "/api/v1/tts/generate"
+        self.health_path = os.getenv("TTS_HEALTH_PATH", "/")
+        self.health_interval = float(os.getenv("TTS_HEALTH_INTERVAL", "10"))
+        # 连续失败多少次后摘除，以及摘除时长（秒）
+        self.eject_failures = int(os.getenv("TTS_EJECT_FAILURES", "3"))
+        self.eject_seconds = float(os.getenv("TTS_EJECT_SECONDS", "30"))
+        self.retries = int(os.getenv("TTS_RETRIES", "1"))
+        self.timeout = float(os.getenv("TTS_TIMEOUT", "30"))
+        # 超过该长度的回复按句拆分并行合成，0表示不拆分
+        self.split_chars = int(os.getenv("TTS_SPLIT_CHARS", "80"))
+        self.audio_dir = os.getenv("AUDIO_DIR", "audio_files")
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._probe_task: Optional[asyncio.Task] = None
+        self._cursor = 0
+        self.metrics: Dict[str, int] = {"split_replies": 0, "segments": 0, "failed_replies": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """各实例共用的HTTP客户端（复用连接）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    def _available(self, now: float) -> List[TTSEndpoint]:
+        # 摘除时间已过的实例进入半开状态，可以再次接收请求
+        return [e for e in self.endpoints if e.healthy or e.ejected_until <= now]
+
+    def pick(self, exclude: List[TTSEndpoint] = ()) -> TTSEndpoint:
+        """选择未完成请求最少的可用实例，全部不可用时仍从中选择"""
+        candidates = [e for e in self._available(time.monotonic()) if e not in exclude]
+        if not candidates:
+            candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        # 起点轮转，请求数相同时分散到不同实例
+        self._cursor = (self._cursor + 1) % len(candidates)
+        ordered = candidates[self._cursor:] + candidates[:self._cursor]
+        return min(ordered, key=lambda e: e.outstanding)
+
+    def _eject(self, endpoint: TTSEndpoint, reason: str):
+        if endpoint.healthy or endpoint.ejected_until <= time.monotonic():
+            print(f"[TTSPool] 摘除实例 {endpoint.url} {self.eject_seconds:.0f} 秒: {reason}")
+        endpoint.healthy = False
+        endpoint.ejected_until = time.monotonic() + self.eject_seconds
+
+    def _restore(self, endpoint: TTSEndpoint):
+        if not endpoint.healthy:
+            print(f"[TTSPool] 实例 {endpoint.url} 已恢复")
+        endpoint.healthy = True
+        endpoint.failures = 0
+
+    @contextlib.asynccontextmanager
+    async def lease(self, exclude: List[TTSEndpoint] = ()):
+        """占用一个实例执行请求，结束后按结果更新实例状态（被取消的请求不计失败）"""
+        endpoint = self.pick(exclude)
+        endpoint.outstanding += 1
+        start = time.perf_counter()
+        try:
+            yield endpoint
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            endpoint.errors += 1
+            endpoint.failures += 1
+            if endpoint.failures >= self.eject_failures:
+                self._eject(endpoint, str(e))
+            raise
+        else:
+            self._restore(endpoint)
+        finally:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            endpoint.total_ms += (time.perf_counter() - start) * 1000
+
+    async def generate(self, text: str, make_payload: Callable[[str], Dict]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        在一个实例上合成整段文本，失败时换实例重试
+
+        Returns:
+            (音频路径, 实例地址)，失败返回 (None, None)
+        """
+        tried: List[TTSEndpoint] = []
+        for _ in range(self.retries + 1):
+            try:
+                async with self.lease(tried) as endpoint:
+                    tried.append(endpoint)
+                    response = await self.client.post(
+                        f"{endpoint.url}{self.generate_path}", json=make_payload(text)
+                    )
+                    if response.status_code != 200:
+                        raise RuntimeError(f"HTTP {response.status_code}")
+                    body = response.json()
+                    if not body.get("success"):
+                        raise RuntimeError(body.get("message", "合成失败"))
+                    return body["data"]["audio"], endpoint.url
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[TTSPool] 实例 {tried[-1].url if tried else ''} 合成失败: {str(e)}")
+        return None, None
+
+    def split(self, text: str) -> List[str]:
+        """长回复按句拆分；只有一个可用实例或没有共享音频目录时不拆分"""
+        if (
+            self.split_chars <= 0
+            or len(text) <= self.split_chars
+            or len(self._available(time.monotonic())) < 2
+            or not os.path.isdir(self.audio_dir)
+        ):
+            return [text]
+        return split_sentences(text, self.split_chars)
+
+    async def read_audio(self, audio_file: str, endpoint_url: str) -> bytes:
+        """读取合成结果，优先读取共享目录中的文件"""
+        local_path = os.path.join(self.audio_dir, os.path.basename(audio_file))
+        if os.path.exists(local_path):
+            async with aiofiles.open(local_path, "rb") as f:
+                return await f.read()
+        response = await self.client.get(f"{endpoint_url}{audio_file}")
+        response.raise_for_status()
+        return response.content
+
+    async def synthesize(self, text: str, make_payload: Callable[[str], Dict]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        合成回复音频，长回复拆分后并行合成并按顺序拼接为一个文件
+
+        Returns:
+            (音频路径, 实例地址)，失败返回 (None, None)
+        """
+        segments = self.split(text)
+        if len(segments) == 1:
+            return await self.generate(text, make_payload)
+
+        self.metrics["split_replies"] += 1
+        self.metrics["segments"] += len(segments)
+        results = await asyncio.gather(*(self.generate(segment, make_payload) for segment in segments))
+        if any(audio_file is None for audio_file, _ in results):
+            self.metrics["failed_replies"] += 1
+            return None, None
+
+        parts = await asyncio.gather(*(self.read_audio(audio_file, url) for audio_file, url in results))
+        combined = b"".join([parts[0]] + [strip_id3(part) for part in parts[1:]])
+        # 写入共享目录，由TTS实例按相同的路径前缀对外提供
+        filename = f"tts_{uuid.uuid4().hex}.mp3"
+        async with aiofiles.open(os.path.join(self.audio_dir, filename), "wb") as f:
+            await f.write(combined)
+        first_file, first_url = results[0]
+        print(f"[TTSPool] 回复拆分为 {len(segments)} 段并行合成，已拼接为 {filename}")
+        return posixpath.join(posixpath.dirname(first_file), filename), first_url
+
+    async def _probe(self, endpoint: TTSEndpoint):
+        try:
+            response = await self.client.get(f"{endpoint.url}{self.health_path}", timeout=5.0)
+            if response.status_code >= 500:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            self._restore(endpoint)
+        except Exception as e:
+            self._eject(endpoint, f"健康检查失败: {str(e) or type(e).__name__}")
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self._probe(endpoint) for endpoint in self.endpoints))
+            await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        """启动健康检查任务（只有一个实例时不检查）"""
+        if len(self.endpoints) > 1 and self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+        print(f"[TTSPool] TTS实例: {', '.join(e.url for e in self.endpoints)}")
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def get_metrics(self) -> Dict:
+        """获取各实例的排队长度、请求数、错误数和平均耗时"""
+        now = time.monotonic()
+        return {
+            **self.metrics,
+            "endpoints": [
+                {
+                    "url": e.url,
+                    "healthy": e.healthy,
+                    "ejected_for": max(e.ejected_until - now, 0.0) if not e.healthy else 0.0,
+                    "outstanding": e.outstanding,
+                    "requests": e.requests,
+                    "errors": e.errors,
+                    "avg_ms": e.total_ms / e.requests if e.requests else 0.0,
+                }
+                for e in self.endpoints
+            ],
+        }
+
+
+# 创建全局实例
+tts_pool = TTSPool()
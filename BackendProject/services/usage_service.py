@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+大模型用量统计
+记录每次大模型调用的输入、输出和缓存命中token数及耗时，按客户端、调用类型和提供商汇总；
+调用明细保存在固定大小的环形缓冲区中，定期追加写入本地文件。
+每个客户端在统计窗口内的用量超过软上限时切换到快速模型，超过硬上限时拒绝新的对话
+"""
+import asyncio
+import json
+import os
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import aiofiles
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 调用类型
+CALL_CHAT = "chat"
+CALL_ANIMATION = "animation"
+CALL_PHOTO = "photo"
+CALL_IMAGE = "image"
+
+# 当前任务所属的客户端，由对话轮次设置，大模型服务记录用量时读取
+current_client: ContextVar[Optional[str]] = ContextVar("current_client", default=None)
+
+# 用量状态
+BUDGET_OK = "ok"
+BUDGET_SOFT = "soft"
+BUDGET_EXCEEDED = "exceeded"
+
+
+class BudgetExceeded(Exception):
+    """客户端用量超过硬上限"""
+
+
+def usage_from_openai(message) -> Tuple[int, int, int]:
+    """从LangChain消息的usage_metadata中取出 (输入, 输出, 缓存命中) token数"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+    return usage.get("input_tokens", 0), usage.get("output_tokens", 0), cached or 0
+
+
+def usage_from_zhipu(usage) -> Tuple[int, int, int]:
+    """从智谱AI响应的usage中取出 (输入, 输出, 缓存命中) token数"""
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) if details is not None else 0
+    return usage.prompt_tokens or 0, usage.completion_tokens or 0, cached or 0
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数：非ASCII字符（中文等）每字约1个token，ASCII字符每4个约1个token"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+
+def parse_prices(spec: str) -> Dict[str, Tuple[float, float]]:
+    """解析 "模型:输入单价/输出单价,..." 格式的价格配置（每百万token）"""
+    prices = {}
+    for item in spec.split(","):
+        if ":" in item:
+            model, value = item.rsplit(":", 1)
+            prompt_price, _, completion_price = value.partition("/")
+            prices[model.strip()] = (float(prompt_price), float(completion_price or prompt_price))
+    return prices
+
+
+class ClientUsage:
+    """单个客户端的用量：按时间分桶的token数环形数组，以及按调用类型的累计值"""
+
+    __slots__ = ("buckets", "last_bucket", "by_call", "last_seen")
+
+    def __init__(self, bucket_count: int):
+        self.buckets = [0] * bucket_count
+        self.last_bucket = 0
+        # 调用类型 -> [调用次数, 输入token, 输出token, 缓存token, 耗时ms, 费用]
+        self.by_call: Dict[str, List[float]] = {}
+        self.last_seen = 0.0
+
+    def _advance(self, bucket: int):
+        # 清空上次写入之后已过期的分桶
+        count = len(self.buckets)
+        for i in range(self.last_bucket + 1, min(bucket, self.last_bucket + count) + 1):
+            self.buckets[i % count] = 0
+        self.last_bucket = max(bucket, self.last_bucket)
+
+    def add(self, bucket: int, tokens: int):
+        self._advance(bucket)
+        self.buckets[bucket % len(self.buckets)] += tokens
+
+    def window_tokens(self, bucket: int) -> int:
+        self._advance(bucket)
+        return sum(self.buckets)
+
+
+class UsageTracker:
+    """大模型用量统计和客户端额度控制"""
+
+    def __init__(self):
+        self.enabled = os.getenv("USAGE_ENABLED", "true").lower() == "true"
+        self.usage_dir = os.getenv("USAGE_DIR", "usage_logs")
+        self.flush_interval = float(os.getenv("USAGE_FLUSH_INTERVAL", "60"))
+        # 额度统计窗口和分桶粒度（秒）
+        self.window = int(os.getenv("USAGE_BUDGET_WINDOW", "3600"))
+        self.bucket_seconds = int(os.getenv("USAGE_BUCKET_SECONDS", "60"))
+        self.bucket_count = max(self.window // self.bucket_seconds, 1)
+        # 每个客户端在统计窗口内的token上限，0表示不限制；可按客户端单独配置
+        self.default_budget = int(os.getenv("USAGE_CLIENT_BUDGET_TOKENS", "0"))
+        self.budgets = {
+            client.strip(): int(value)
+            for client, _, value in (item.partition(":") for item in os.getenv("USAGE_CLIENT_BUDGETS", "").split(","))
+            if value
+        }
+        # 超过额度的该比例后切换到快速模型
+        self.soft_ratio = float(os.getenv("USAGE_BUDGET_SOFT_RATIO", "0.8"))
+        self.prices = parse_prices(os.getenv("USAGE_PRICES", ""))
+
+        # 调用明细环形缓冲区，seq为已写入的总条数
+        self.ring_size = int(os.getenv("USAGE_RING_SIZE", "10000"))
+        self._ring: List[Optional[tuple]] = [None] * self.ring_size
+        self._seq = 0
+        self._flushed = 0
+
+        self.clients: Dict[str, ClientUsage] = {}
+        # (调用类型, 提供商, 模型) -> [调用次数, 输入token, 输出token, 缓存token, 耗时ms, 费用]
+        self.totals: Dict[Tuple[str, str, str], List[float]] = {}
+        self.metrics: Dict[str, int] = {"records": 0, "flushed": 0, "dropped": 0, "estimated": 0, "soft_limited": 0, "throttled": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        """尚未写入文件的记录数"""
+        return min(self._seq - self._flushed, self.ring_size)
+
+    @property
+    def budgets_enabled(self) -> bool:
+        """是否配置了客户端额度"""
+        return self.enabled and (self.default_budget > 0 or bool(self.budgets))
+
+    def budget_for(self, client_id: str) -> int:
+        return self.budgets.get(client_id, self.default_budget)
+
+    def record(
+        self,
+        call_type: str,
+        provider: str,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int,
+        latency_ms: float,
+        estimated: bool = False
+    ):
+        """记录一次大模型调用，客户端取自当前任务的上下文；estimated表示用量是按文本长度估算的"""
+        if not self.enabled:
+            return
+        if estimated:
+            self.metrics["estimated"] += 1
+        client_id = current_client.get() or "system"
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+        values = (1, prompt_tokens, completion_tokens, cached_tokens, latency_ms, cost)
+
+        now = time.time()
+        client = self.clients.get(client_id)
+        if client is None:
+            client = self.clients[client_id] = ClientUsage(self.bucket_count)
+            client.last_bucket = int(now // self.bucket_seconds)
+        client.add(int(now // self.bucket_seconds), prompt_tokens + completion_tokens)
+        client.last_seen = now
+        for totals in (
+            client.by_call.setdefault(call_type, [0] * 6),
+            self.totals.setdefault((call_type, provider, model), [0] * 6),
+        ):
+            for i, value in enumerate(values):
+                totals[i] += value
+
+        self._ring[self._seq % self.ring_size] = (
+            now, client_id, call_type, provider, model,
+            prompt_tokens, completion_tokens, cached_tokens, round(latency_ms, 1), cost,
+        )
+        self._seq += 1
+        self.metrics["records"] += 1
+
+    def budget_status(self, client_id: Optional[str] = None) -> str:
+        """获取客户端（默认为当前任务的客户端）的额度状态"""
+        client_id = client_id or current_client.get()
+        budget = self.budget_for(client_id) if client_id else 0
+        client = self.clients.get(client_id) if client_id else None
+        if not self.enabled or budget <= 0 or client is None:
+            return BUDGET_OK
+        used = client.window_tokens(int(time.time() // self.bucket_seconds))
+        if used >= budget:
+            return BUDGET_EXCEEDED
+        if used >= budget * self.soft_ratio:
+            return BUDGET_SOFT
+        return BUDGET_OK
+
+    def check(self) -> str:
+        """检查当前客户端的额度，超过硬上限时抛出BudgetExceeded，否则返回额度状态"""
+        status = self.budget_status()
+        if status == BUDGET_EXCEEDED:
+            self.metrics["throttled"] += 1
+            raise BudgetExceeded("使用额度已用完，请稍后再试")
+        return status
+
+    def enforce(self) -> bool:
+        """
+        检查当前客户端的额度，超过硬上限时抛出BudgetExceeded
+
+        Returns:
+            是否应切换到快速模型（超过软上限）
+        """
+        if self.check() == BUDGET_SOFT:
+            self.metrics["soft_limited"] += 1
+            return True
+        return False
+
+    def _take_pending(self) -> Tuple[List[tuple], int]:
+        """取出上次写入之后的记录及其结束序号，写入成功后才推进已写入位置"""
+        # 两次写入之间超过缓冲区大小的记录已被覆盖
+        start = max(self._flushed, self._seq - self.ring_size)
+        if start > self._flushed:
+            self.metrics["dropped"] += start - self._flushed
+            self._flushed = start
+        end = self._seq
+        return [self._ring[seq % self.ring_size] for seq in range(start, end)], end
+
+    async def flush(self):
+        """将上次写入之后的调用明细追加到当天的JSONL文件，并清理窗口内无用量的客户端"""
+        records, end = self._take_pending()
+        if records:
+            fields = ("at", "client_id", "call_type", "provider", "model",
+                      "prompt_tokens", "completion_tokens", "cached_tokens", "latency_ms", "cost")
+            lines = "".join(json.dumps(dict(zip(fields, record)), ensure_ascii=False) + "\n" for record in records)
+            os.makedirs(self.usage_dir, exist_ok=True)
+            filename = os.path.join(self.usage_dir, f"usage_{datetime.now().strftime('%Y%m%d')}.jsonl")
+            # 写入失败时记录保留在缓冲区，下次重试；期间被覆盖的记录计入dropped
+            async with aiofiles.open(filename, "a", encoding="utf-8") as f:
+                await f.write(lines)
+            self._flushed = max(self._flushed, end)
+            self.metrics["flushed"] += len(records)
+
+        cutoff = time.time() - self.window
+        for client_id in [c for c, usage in self.clients.items() if usage.last_seen < cutoff]:
+            del self.clients[client_id]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[UsageTracker] 写入用量记录失败: {str(e)}")
+
+    def start(self):
+        """启动定期写入任务"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+            print(f"[UsageTracker] 用量统计已启动，每 {self.flush_interval:.0f} 秒写入 {self.usage_dir}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.enabled:
+            await self.flush()
+
+    @staticmethod
+    def _summary(values: List[float]) -> Dict:
+        calls, prompt, completion, cached, latency_ms, cost = values
+        return {
+            "calls": calls,
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "cached_tokens": cached,
+            "avg_latency_ms": round(latency_ms / calls, 1) if calls else 0.0,
+            "cost": round(cost, 6),
+        }
+
+    def get_client_usage(self, client_id: str) -> Optional[Dict]:
+        """获取单个客户端的窗口用量、额度状态和按调用类型的累计值"""
+        client = self.clients.get(client_id)
+        if client is None:
+            return None
+        return {
+            "client_id": client_id,
+            "window_tokens": client.window_tokens(int(time.time() // self.bucket_seconds)),
+            "budget": self.budget_for(client_id),
+            "status": self.budget_status(client_id),
+            "by_call": {call_type: self._summary(values) for call_type, values in client.by_call.items()},
+        }
+
+    def get_metrics(self, top: int = 10) -> Dict:
+        """获取按调用类型和模型的累计用量，以及窗口内用量最多的客户端"""
+        bucket = int(time.time() // self.bucket_seconds)
+        heaviest = sorted(
+            ((client.window_tokens(bucket), client_id) for client_id, client in self.clients.items()),
+            reverse=True,
+        )[:top]
+        return {
+            **self.metrics,
+            "window_seconds": self.window,
+            "by_call": [
+                {"call_type": call_type, "provider": provider, "model": model, **self._summary(values)}
+                for (call_type, provider, model), values in self.totals.items()
+            ],
+            "top_clients": [
+                {"client_id": client_id, "window_tokens": tokens, "budget": self.budget_for(client_id)}
+                for tokens, client_id in heaviest
+            ],
+        }
+
+
+# 创建全局实例
+usage_tracker = UsageTracker()
@@ -182,7 +182,7 @@ export class WebSocketManager {
         try {
           // 尝试解析JSON格式的消息
           const parsedData = JSON.parse(event.data as string) as {
-            type?: number;
+            type?: number | string;
             content?: unknown;
             animation_index?: number;
             audio?: string;
@@ -190,6 +190,17 @@ export class WebSocketManager {
             prompt?: string;
           };
 
+          // 服务端心跳，直接回复pong，不作为消息显示
+          if (parsedData.type === 'ping') {
+            this._ws?.send(
+              JSON.stringify({
+                type: 'pong',
+                data: { timestamp: new Date().toISOString() }
+              })
+            );
+            return;
+          }
+
           // 根据type字段确定内容类型
           let contentType: 'text' | 'audio' = 'text';
           if (parsedData.type === 3) {